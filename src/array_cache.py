@@ -0,0 +1,238 @@
+#!/usr/local/bin/python2.6
+"""
+Purpose
+-------
+    Keeps the decoded data of GPCP files in a cache directory so files that
+    are converted again, with other output options, are memory mapped from
+    the cache instead of being read, decompressed and decoded again.
+
+Program Flow
+------------
+    Input:
+        The name of a GPCP file, plain or gzip, and the cache directory.
+
+    Output:
+        For each file two entries in the cache directory named after the md5
+        of the file contents:
+            <md5>.f32   the floats of every complete time step in the byte
+                        order of this machine, ready to be memory mapped.
+            <md5>.json  the header of the file, the variables parsed from it
+                        and the shape of the data.
+
+
+Notes/Lessons Learned
+---------------------
+    The key is the checksum of the contents, not the name, so a file that is
+    replaced is decoded again and a file that is copied or renamed is not.
+    Hashing the file reads it once, which is still much cheaper than
+    decompressing and decoding it.
+
+    The cache is kept under its size limit by removing the entries used
+    least recently.  An entry is marked as used by updating the modification
+    time of its .f32 file.
+
+--------
+
+"""
+#------------------------------------------------------------------------------
+#     Imports
+#------------------------------------------------------------------------------
+
+
+# built-ins
+import array
+import gzip
+import hashlib
+import json
+import os
+import sys
+
+# external
+import gpcp_parsers
+import manifest
+
+# The default size limit of the cache, in megabytes.
+DEFAULT_SIZE = 1024
+
+# The byte order is part of the key, the cached floats are native.
+_SUFFIX = "_" + sys.byteorder
+
+#------------------------------------------------------------------------------
+#     Functions
+#------------------------------------------------------------------------------
+
+
+def content_key(filename, block_size=1024 * 1024):
+    """ Returns the md5 of the contents of filename as the key of its cache
+    entry.
+
+    """
+    checksum = hashlib.md5()
+    with open(filename, 'rb') as handle:
+        while True:
+            block = handle.read(block_size)
+            if not block:
+                break
+            checksum.update(block)
+
+    return checksum.hexdigest() + _SUFFIX
+
+#------------------------------------------------------------------------------
+#     Class:  GpcpCachedData
+#------------------------------------------------------------------------------
+
+
+class GpcpCachedData(gpcp_parsers.GpcpLazyData):
+    """ The decoded data of a GPCP file memory mapped from the cache.  The
+    floats are already in the byte order of this machine so a time step is
+    only copied out of the map, never decoded.
+
+    """
+    def get_step(self, step):
+        """ Returns all the values of one time step. """
+        if self._step[0] != step:
+            values = array.array('f')
+            values.fromstring(str(self.get_view(step)))
+            self._step = (step, values)
+
+        return self._step[1]
+
+#------------------------------------------------------------------------------
+#     Class:  ArrayCache
+#------------------------------------------------------------------------------
+
+
+class ArrayCache(object):
+    """ A directory of decoded GPCP data with a size limit. """
+    def __init__(self, directory, size=DEFAULT_SIZE):
+        """ The initialization function for an object.  size is the limit
+        of the cache in megabytes.
+
+        """
+        self.directory = directory
+        self.max_bytes = size * 1024 * 1024
+
+    def entry_names(self, key):
+        """ Returns the (data, metadata) file names of the entry for key. """
+        base = os.path.join(self.directory, key)
+        return base + ".f32", base + ".json"
+
+    def open_parser(self, filename, zipped, parser_class=None):
+        """ Returns the parser for filename with its data from the cache,
+        decoding and caching it first if it is not there yet.  The parser
+        must be closed once done with.
+
+        Raises:
+            IOError if the file can not be read or is not a GPCP file.
+
+        """
+        key = content_key(filename)
+        parser = self.load(key, parser_class)
+        if parser is not None:
+            return parser
+
+        if zipped:
+            handle = gzip.open(filename, 'rb')
+        else:
+            handle = open(filename, 'rb')
+
+        try:
+            parser = gpcp_parsers.open_parser(handle,
+                                              parser_class=parser_class)
+        finally:
+            handle.close()
+
+        if parser.has_data():
+            self.store(key, parser)
+
+        return parser
+
+    def load(self, key, parser_class=None):
+        """ Returns a parser with the cached data of key memory mapped, or
+        None if key is not in the cache.
+
+        """
+        data_name, meta_name = self.entry_names(key)
+        try:
+            with open(meta_name, 'r') as handle:
+                meta = json.load(handle)
+            data_file = open(data_name, 'rb')
+        except (IOError, ValueError):
+            return None
+
+        try:
+            header = str(meta["header"])
+            parser = gpcp_parsers.header_parser(header, parser_class)
+            parser.data = GpcpCachedData(data_file,
+                                         0,
+                                         meta["points_per_row"],
+                                         meta["rows"])
+        finally:
+            # The map keeps its own reference to the file.
+            data_file.close()
+
+        # Mark the entry as the most recently used.
+        os.utime(data_name, None)
+
+        return parser
+
+    def store(self, key, parser):
+        """ Writes the decoded data and header of parser to the cache as the
+        entry for key, then evicts entries to stay under the size limit.
+
+        """
+        data_name, meta_name = self.entry_names(key)
+        steps, rows, points_per_row = parser.data.shape
+
+        meta = {"header": parser.header,
+                "variables": parser.variables,
+                "steps": steps,
+                "rows": rows,
+                "points_per_row": points_per_row}
+
+        # The data goes first, an entry is only used once its metadata is
+        # there.
+        manifest.write_atomic(data_name, parser.data.values.tofile)
+        manifest.write_atomic(meta_name,
+                              lambda handle: json.dump(meta, handle))
+
+        self.evict(keep=key)
+
+    def evict(self, keep=None):
+        """ Removes the least recently used entries, other than keep, until
+        the cache is under its size limit.
+
+        """
+        entries = []
+        total = 0
+        for name in os.listdir(self.directory):
+            if not name.endswith(".f32"):
+                continue
+
+            key = name[:-len(".f32")]
+            data_name, meta_name = self.entry_names(key)
+            try:
+                size = os.path.getsize(data_name)
+                used = os.path.getmtime(data_name)
+                if os.path.exists(meta_name):
+                    size += os.path.getsize(meta_name)
+            except OSError:
+                # Removed by another process.
+                continue
+
+            total += size
+            if key != keep:
+                entries.append((used, size, key))
+
+        entries.sort()
+        for _used, size, key in entries:
+            if total <= self.max_bytes:
+                break
+
+            # The metadata goes first so the entry is never used half gone.
+            for name in reversed(self.entry_names(key)):
+                try:
+                    os.remove(name)
+                except OSError:
+                    pass
+            total -= size
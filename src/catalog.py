@@ -0,0 +1,293 @@
+#!/usr/local/bin/python2.6
+"""
+Purpose
+-------
+    Builds a catalog (index) of every GPCP file under a directory tree by
+    reading only the header record of each file.  Batch runs of gpcp_to_csv
+    can then plan from the catalog instead of guessing file names and only
+    finding out a file is missing or truncated when it is opened.
+
+Program Flow
+------------
+    Input:
+        The directory to catalog and the name of the catalog file, i.e.
+        python catalog.py ../docs -o gpcp_catalog.json
+
+        With --verify every file is also read to its end, i.e.
+        python catalog.py ../docs -o gpcp_catalog.json --verify
+
+    Output:
+        A JSON file with one entry per GPCP file holding the year, month,
+        month or day range, dimensions, grid, creation date, the header, the
+        size the header declares, the actual size and a checksum of the
+        header.  With --verify each entry also holds a checksum of the whole
+        uncompressed file.
+
+
+Notes/Lessons Learned
+---------------------
+    Only the header of each file is read.  The uncompressed size of a gzip
+    file is taken from its last four bytes (the gzip ISIZE field, the size
+    modulo 4 GB), which is only right for a whole file: when the file is
+    truncated those bytes are just compressed data.  Such sizes are marked
+    with size_verified false.  --verify decompresses each gzip file to its
+    end instead, which counts the real size and checks the gzip CRC, so a
+    truncated or corrupt file is marked as not complete, at the cost of
+    reading the whole archive.
+
+    The header checksum only identifies the header, a file whose data was
+    replaced or damaged under the same header has the same one.  The data
+    checksum written with --verify covers the whole file.  Files that are
+    not GPCP files are left out of the catalog.
+
+--------
+
+"""
+#------------------------------------------------------------------------------
+#     Imports
+#------------------------------------------------------------------------------
+
+
+# The __future__ print function is used to ensure an easier path to
+# Python 3 if and when the upgrade is needed.
+from __future__ import print_function
+
+# built-ins
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import struct
+import zlib
+
+# external
+import gpcp_parsers
+
+#------------------------------------------------------------------------------
+#     Functions
+#------------------------------------------------------------------------------
+
+
+def gzip_isize(filename):
+    """ Returns the uncompressed size modulo 4 GB a gzip file gives in its
+    last four bytes, only right if the file is whole.
+
+    """
+    with open(filename, 'rb') as handle:
+        handle.seek(0, os.SEEK_END)
+        if handle.tell() < 4:
+            return 0
+        handle.seek(-4, os.SEEK_END)
+        return struct.unpack("<I", handle.read(4))[0]
+
+
+def read_data(filename, zipped, block_size=1024 * 1024):
+    """ Reads a file, decompressing a gzip file, to its end.
+
+    Returns:
+        A tuple of (the number of bytes read, True if the file could be read
+        to its end and for a gzip file its CRC and size check out, the md5
+        of the bytes read).
+
+    """
+    size = 0
+    checksum = hashlib.md5()
+    if zipped:
+        handle = gzip.open(filename, 'rb')
+    else:
+        handle = open(filename, 'rb')
+
+    try:
+        while True:
+            block = handle.read(block_size)
+            if not block:
+                return size, True, checksum.hexdigest()
+            size += len(block)
+            checksum.update(block)
+
+    except (IOError, EOFError, zlib.error):
+        # Truncated or corrupt.
+        return size, False, checksum.hexdigest()
+
+    finally:
+        handle.close()
+
+
+def declared_size(variables):
+    """ Returns the size in bytes of the whole file the header declares. """
+    dimensions = variables["dimensions"].strip(")").split("x")
+    data_size = int(variables["thing_size"])
+    for dimension in dimensions[1:]:
+        data_size *= int(dimension)
+
+    return int(variables["row_size"]) + data_size
+
+
+def read_entry(filename, verify=False):
+    """ Reads the header of filename and returns its catalog entry.  With
+    verify the file is also read to its end, see read_data.
+
+    Raises:
+        IOError if the file can not be read or is not a GPCP file.
+
+    """
+    zipped = filename.endswith(".gz")
+    if zipped:
+        handle = gzip.open(filename, 'rb')
+    else:
+        handle = open(filename, 'rb')
+
+    try:
+        header = gpcp_parsers.read_header(handle)
+    finally:
+        handle.close()
+
+    parser_class = gpcp_parsers.detect_parser(header)
+    variables = parser_class.get_variables(header)
+    daily = parser_class is gpcp_parsers.GpcpParserNewOneLine
+
+    stat = os.stat(filename)
+    intact = True
+    data_checksum = None
+    if verify:
+        actual_size, intact, data_checksum = read_data(filename, zipped)
+    elif zipped:
+        actual_size = gzip_isize(filename)
+    else:
+        actual_size = stat.st_size
+
+    entry = {"path": filename,
+             "zipped": zipped,
+             "kind": "daily" if daily else "monthly",
+             "year": int(variables["year"]),
+             "month": int(variables["month"]) if daily else None,
+             "start": int(variables["start_day" if daily
+                                    else "start_month"]),
+             "end": int(variables["end_day" if daily else "end_month"]),
+             "points_per_row": int(variables["points_per_row"]),
+             "rows_per_step": int(variables["rows_per_day" if daily
+                                            else "rows_per_month"]),
+             "dimensions": variables["dimensions"],
+             "grid": variables["grid"],
+             "creation_date": variables["creation_date"],
+             "declared_size": declared_size(variables),
+             "actual_size": actual_size,
+             "size_verified": verify or not zipped,
+             "mtime": stat.st_mtime,
+             "header": header,
+             "header_checksum": hashlib.md5(header).hexdigest(),
+             "data_checksum": data_checksum}
+    entry["complete"] = intact and \
+                        entry["actual_size"] >= entry["declared_size"]
+
+    return entry
+
+
+def build_catalog(root, verify=False):
+    """ Walks the directory tree under root and returns the catalog of every
+    GPCP file found, sorted by path.  verify is as for read_entry.
+
+    """
+    entries = []
+    for dirpath, _dirnames, filenames in os.walk(root):
+        for name in filenames:
+            try:
+                entries.append(read_entry(os.path.join(dirpath, name),
+                                          verify))
+            except (IOError, ValueError, IndexError):
+                # Not a GPCP file, leave it out of the catalog.
+                continue
+
+    entries.sort(key=lambda entry: entry["path"])
+    return {"root": root, "files": entries}
+
+
+def save_catalog(catalog, filename):
+    """ Writes the catalog to filename as JSON. """
+    with open(filename, 'w') as handle:
+        json.dump(catalog, handle, indent=1, sort_keys=True)
+
+
+def load_catalog(filename):
+    """ Reads a catalog written by save_catalog. """
+    with open(filename, 'r') as handle:
+        return json.load(handle)
+
+
+def find_files(catalog, years, months=None, kinds=("daily", "monthly")):
+    """ Returns the catalog entries for the given years (and months for the
+    daily files) of the given kinds, sorted by path.  years and months are
+    lists of numbers or strings, months None means every month.
+
+    """
+    years = [int(year) for year in years]
+    if months is not None:
+        months = [int(month) for month in months]
+
+    found = []
+    for entry in catalog["files"]:
+        if entry["kind"] not in kinds or entry["year"] not in years:
+            continue
+        if entry["kind"] == "daily" and months is not None and \
+           entry["month"] not in months:
+            continue
+
+        found.append(entry)
+
+    return found
+
+#------------------------------------------------------------------------------
+#     Main
+#------------------------------------------------------------------------------
+
+
+def main():
+    """ The 'main' function used to run the file/modules as a stand alone
+    application.
+
+    """
+    parser = argparse.ArgumentParser(description="Catalogs the GPCP files " + \
+                                     "under a directory by reading only " + \
+                                     "their headers.")
+    parser.add_argument('directory',
+                        help="The directory to catalog, sub directories " + \
+                             "are included.")
+    parser.add_argument('-o',
+                        '--output_file',
+                        default="./gpcp_catalog.json",
+                        help="The catalog file to write, the default is " + \
+                             "'./gpcp_catalog.json'.")
+    parser.add_argument('-V',
+                        '--verify',
+                        action='store_true',
+                        help="Set this flag to read every file to its " + \
+                             "end, checking the size and CRC of gzip " + \
+                             "files and writing a checksum of the data.")
+    args = parser.parse_args()
+
+    catalog = build_catalog(args.directory, args.verify)
+    save_catalog(catalog, args.output_file)
+
+    for entry in catalog["files"]:
+        if not entry["complete"]:
+            print("Truncated or corrupt: " + entry["path"] + " has " + \
+                  str(entry["actual_size"]) + " of " + \
+                  str(entry["declared_size"]) + " bytes.")
+
+    unverified = len([entry for entry in catalog["files"]
+                      if not entry["size_verified"]])
+    if unverified:
+        print("\nThe sizes of " + str(unverified) + " gzip files are " + \
+              "from their gzip trailers, use --verify to check them.")
+
+    print("\nCataloged " + str(len(catalog["files"])) + " files in " + \
+          args.output_file + "\n")
+
+#------------------------------------------------------------------------------
+#     Name
+#------------------------------------------------------------------------------
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,556 @@
+#!/usr/local/bin/python2.6
+"""
+Purpose
+-------
+    Consolidates a directory of GPCP files into cubes, one memory mappable
+    array of time x latitude x longitude per kind of file and grid, so a
+    question over many years reads one store instead of opening and decoding
+    hundreds of files.  The CSV files of any of the original files can be
+    written back out of a cube with the same writers gpcp_to_csv uses.
+
+Program Flow
+------------
+    Input:
+        To ingest, the directory of GPCP files and the store directory,
+        i.e. python cube.py ingest ../docs gpcp_store
+
+        To export, the store directory and the output prefix as for
+        gpcp_to_csv, i.e. python cube.py export gpcp_store -op out_ -f 3
+
+    Output:
+        The store directory holds index.json, the names of its cubes, and a
+        directory per cube, i.e. monthly_144x72 or daily_360x180, with:
+            index.json  the grid, the chunking, the date of every time step
+                        and the header and time steps of every file
+                        ingested.
+            data.f32    the floats in the byte order of this machine, in
+                        chunks of TIME_BLOCK time steps by TILE_ROWS rows by
+                        TILE_COLS columns.
+
+        Exporting writes one CSV file per file ingested, named as
+        gpcp_to_csv names them.
+
+
+Notes/Lessons Learned
+---------------------
+    Every chunk is the same size, the ones at the edges are padded with the
+    missing value, so the offset of any chunk is found by multiplication.  A
+    box over a range of time only touches the chunks that overlap it, which
+    the operating system reads in through the memory map as they are used.
+
+    A file is ingested as gpcp_to_csv would convert it, every complete time
+    step it holds, so the exported CSV files are the same as converting the
+    original files.
+
+--------
+
+"""
+#------------------------------------------------------------------------------
+#     Imports
+#------------------------------------------------------------------------------
+
+
+# The __future__ print function is used to ensure an easier path to
+# Python 3 if and when the upgrade is needed.
+from __future__ import print_function
+
+# built-ins
+import argparse
+import array
+import datetime
+import gzip
+import json
+import mmap
+import os
+import shutil
+import sys
+import tempfile
+
+# external
+import catalog
+import gpcp_parsers
+import gpcp_to_csv
+import manifest
+
+# The chunking of the cubes, in time steps, rows and columns.
+TIME_BLOCK = 16
+TILE_ROWS = 36
+TILE_COLS = 36
+
+# The parser for each kind of file.
+KIND_PARSERS = {"monthly": gpcp_parsers.GpcpParserOriginalOneLine,
+                "daily": gpcp_parsers.GpcpParserNewOneLine}
+
+#------------------------------------------------------------------------------
+#     Functions
+#------------------------------------------------------------------------------
+
+
+def ceil_div(count, size):
+    """ Returns the number of blocks of size needed to hold count. """
+    return (count + size - 1) // size
+
+
+def step_dates(variables, kind, steps):
+    """ Returns the YYYYMMDD date of each of the first steps time steps of a
+    file, the dates the one-line writers give them.
+
+    """
+    year = int(variables["year"])
+    if kind == "monthly":
+        return [int(datetime.date(year, step + 1, 1).strftime("%Y%m%d"))
+                for step in xrange(steps)]
+
+    month = int(variables["month"])
+    return [int(datetime.date(year, month, step + 1).strftime("%Y%m%d"))
+            for step in xrange(steps)]
+
+
+def iter_file_steps(entry, parser):
+    """ Yields the decoded values of every complete time step of the file of
+    a catalog entry.
+
+    """
+    if entry["zipped"]:
+        handle = gzip.open(entry["path"], 'rb')
+    else:
+        handle = open(entry["path"], 'rb')
+
+    try:
+        handle.read(len(parser.header))
+        step_size = parser.rows_per_step() * \
+                    int(parser.variables["points_per_row"]) * 4
+        while True:
+            packed = handle.read(step_size)
+            if len(packed) < step_size:
+                break
+
+            yield gpcp_parsers.decode(packed)
+
+    finally:
+        handle.close()
+
+
+def write_block(handle, block, index):
+    """ Writes the time steps in block, each a flat array of a whole grid,
+    as one row of chunks of the cube described by index.
+
+    """
+    rows = index["rows"]
+    cols = index["points_per_row"]
+    tile_rows = index["tile_rows"]
+    tile_cols = index["tile_cols"]
+    missing = array.array('f', [index["missing_value"]])
+
+    for tile_row in xrange(ceil_div(rows, tile_rows)):
+        for tile_col in xrange(ceil_div(cols, tile_cols)):
+            chunk = array.array('f')
+            first_col = tile_col * tile_cols
+            width = min(tile_cols, cols - first_col)
+
+            for values in block:
+                for row in xrange(tile_row * tile_rows,
+                                  (tile_row + 1) * tile_rows):
+                    if row < rows:
+                        start = row * cols + first_col
+                        chunk.extend(values[start:start + width])
+                        chunk.extend(missing * (tile_cols - width))
+                    else:
+                        chunk.extend(missing * tile_cols)
+
+            chunk.extend(missing * ((index["time_block"] - len(block)) *
+                                    tile_rows * tile_cols))
+            chunk.tofile(handle)
+
+
+def build_cube(entries, directory, time_block=TIME_BLOCK, tile_rows=TILE_ROWS,
+               tile_cols=TILE_COLS):
+    """ Writes the cube of the catalog entries, all of one kind and grid and
+    sorted by time, to directory.
+
+    """
+    kind = entries[0]["kind"]
+    first = gpcp_parsers.header_parser(entries[0]["header"],
+                                       KIND_PARSERS[kind])
+    start, delta, points_per_row, rows = first.grid_spec()
+
+    index = {"kind": kind,
+             "grid": first.variables["grid"],
+             "variable": first.variables["variable"],
+             "units": first.variables["units"],
+             "missing_value": float(first.variables["missing_value"]),
+             "start": start,
+             "delta": delta,
+             "points_per_row": points_per_row,
+             "rows": rows,
+             "time_block": time_block,
+             "tile_rows": tile_rows,
+             "tile_cols": tile_cols,
+             "byteorder": sys.byteorder,
+             "times": [],
+             "sources": []}
+
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    data_name = os.path.join(directory, "data.f32")
+    with open(data_name + ".part", 'wb') as handle:
+        block = []
+        for entry in entries:
+            parser = gpcp_parsers.header_parser(entry["header"],
+                                                KIND_PARSERS[kind])
+            first_step = len(index["times"])
+            for values in iter_file_steps(entry, parser):
+                block.append(values)
+                index["times"].append(None)
+                if len(block) == time_block:
+                    write_block(handle, block, index)
+                    block = []
+
+            steps = len(index["times"]) - first_step
+            index["times"][first_step:] = step_dates(parser.variables, kind,
+                                                     steps)
+            index["sources"].append({"path": entry["path"],
+                                     "header": entry["header"],
+                                     "first_step": first_step,
+                                     "steps": steps})
+            print("Ingested " + str(steps) + " time steps from " + \
+                  entry["path"])
+
+        if block:
+            write_block(handle, block, index)
+
+    os.rename(data_name + ".part", data_name)
+    with open(os.path.join(directory, "index.json"), 'w') as handle:
+        json.dump(index, handle, indent=1, sort_keys=True)
+
+
+def ingest(root, store, time_block=TIME_BLOCK, tile_rows=TILE_ROWS,
+           tile_cols=TILE_COLS):
+    """ Catalogs the GPCP files under root and writes a cube per kind of
+    file and grid to the store directory, replacing what was there.
+
+    Returns:
+        The names of the cubes written.
+
+    """
+    groups = {}
+    seen = set()
+    for entry in catalog.build_catalog(root)["files"]:
+        # The same month or year as a plain and a gzip file is only taken
+        # once.
+        when = (entry["kind"], entry["year"], entry["month"])
+        if when in seen:
+            print("Skipping duplicate file: " + entry["path"])
+            continue
+        seen.add(when)
+
+        name = entry["kind"] + "_" + str(entry["points_per_row"]) + "x" + \
+               str(entry["rows_per_step"])
+        groups.setdefault(name, []).append(entry)
+
+    if not os.path.isdir(store):
+        os.makedirs(store)
+
+    # Each cube is built in a temporary directory of the store and only
+    # takes the place of the old one once it and its index.json are whole,
+    # so an ingest that is stopped leaves the store as it was.
+    built = []
+    try:
+        for name, entries in sorted(groups.iteritems()):
+            entries.sort(key=lambda entry: (entry["year"], entry["month"]))
+            temp_dir = tempfile.mkdtemp(prefix=name + ".",
+                                        suffix=manifest.PART_SUFFIX,
+                                        dir=store)
+            built.append((name, temp_dir))
+            os.chmod(temp_dir, 0755)
+            build_cube(entries, temp_dir, time_block, tile_rows, tile_cols)
+
+    except:
+        for _name, temp_dir in built:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+        raise
+
+    for name, temp_dir in built:
+        directory = os.path.join(store, name)
+        if os.path.isdir(directory):
+            # Moved aside first, a directory can not be renamed over one.
+            old_dir = directory + ".old" + manifest.PART_SUFFIX
+            if os.path.isdir(old_dir):
+                shutil.rmtree(old_dir)
+            os.rename(directory, old_dir)
+            os.rename(temp_dir, directory)
+            shutil.rmtree(old_dir)
+        else:
+            os.rename(temp_dir, directory)
+
+    manifest.write_atomic(os.path.join(store, "index.json"),
+                          lambda handle: json.dump({"cubes": sorted(groups)},
+                                                   handle, indent=1),
+                          'w')
+
+    return sorted(groups)
+
+
+def open_store(store):
+    """ Returns the cubes of the store directory. """
+    with open(os.path.join(store, "index.json"), 'r') as handle:
+        names = json.load(handle)["cubes"]
+
+    return [Cube(os.path.join(store, name)) for name in names]
+
+
+def export(store, output_prefix, format_opt=3, prefix_cache="", step_jobs=1,
+           fixed_width=False):
+    """ Writes the CSV file of every file ingested into the store with
+    gpcp_to_csv.write_output, named as gpcp_to_csv names them.  Formats 0
+    and 1 only write the monthly files and format 2 the daily files.
+
+    Returns:
+        The number of files written.
+
+    """
+    if format_opt == 3:
+        kinds = ("daily", "monthly")
+    elif format_opt == 2:
+        kinds = ("daily",)
+    else:
+        kinds = ("monthly",)
+
+    written = 0
+    for cube in open_store(store):
+        try:
+            if cube.index["kind"] not in kinds:
+                continue
+
+            for source in cube.index["sources"]:
+                parser = cube.source_parser(source,
+                                            gpcp_to_csv.PARSERS[format_opt])
+                output_file = output_prefix + parser.variables["year"]
+                if cube.index["kind"] == "daily":
+                    output_file += parser.variables["month"].zfill(2)
+
+                gpcp_to_csv.write_output(parser,
+                                         output_file + ".csv",
+                                         prefix_cache,
+                                         step_jobs,
+                                         fixed_width)
+                written += 1
+
+        finally:
+            cube.close()
+
+    return written
+
+#------------------------------------------------------------------------------
+#     Class:  GpcpCubeData
+#------------------------------------------------------------------------------
+
+
+class GpcpCubeData(gpcp_parsers.GpcpLazyData):
+    """ The time steps of one ingested file read back out of a cube, so the
+    parsers and their writers can use a cube as they would the file.
+
+    """
+    def __init__(self, cube, first_step, steps):
+        """ The initialization function for an object. """
+        gpcp_parsers.GpcpData.__init__(self,
+                                       None,
+                                       steps,
+                                       cube.index["rows"],
+                                       cube.index["points_per_row"])
+        self.cube = cube
+        self.first_step = first_step
+        self._step = (None, None)
+
+    def get_step(self, step):
+        """ Returns all the values of one time step. """
+        if self._step[0] != step:
+            self._step = (step, self.cube.get_step(self.first_step + step))
+
+        return self._step[1]
+
+    def close(self):
+        """ Drops the last time step, the cube is left open. """
+        self._step = (None, None)
+
+#------------------------------------------------------------------------------
+#     Class:  Cube
+#------------------------------------------------------------------------------
+
+
+class Cube(object):
+    """ A cube of a store, memory mapped. """
+    def __init__(self, directory):
+        """ The initialization function for an object. """
+        self.directory = directory
+        with open(os.path.join(directory, "index.json"), 'r') as handle:
+            self.index = json.load(handle)
+
+        if self.index["byteorder"] != sys.byteorder:
+            raise IOError("The cube " + directory + " was written on a " + \
+                          "machine of another byte order.")
+
+        self.chunk_size = self.index["time_block"] * \
+                          self.index["tile_rows"] * \
+                          self.index["tile_cols"] * 4
+        self.mmap = None
+        if self.index["times"]:
+            with open(os.path.join(directory, "data.f32"), 'rb') as handle:
+                self.mmap = mmap.mmap(handle.fileno(), 0,
+                                      access=mmap.ACCESS_READ)
+
+    def close(self):
+        """ Unmaps the data. """
+        if self.mmap is not None:
+            self.mmap.close()
+            self.mmap = None
+
+    def chunk_offset(self, block, tile_row, tile_col):
+        """ Returns the byte offset of a chunk in data.f32. """
+        tiles_down = ceil_div(self.index["rows"], self.index["tile_rows"])
+        tiles_across = ceil_div(self.index["points_per_row"],
+                                self.index["tile_cols"])
+
+        return ((block * tiles_down + tile_row) * tiles_across + tile_col) * \
+               self.chunk_size
+
+    def read_box(self, step, first_row, last_row, first_col, last_col):
+        """ Returns the values of rows first_row to last_row and columns
+        first_col to last_col, inclusive, of one time step as a flat array in
+        row order.
+
+        """
+        tile_rows = self.index["tile_rows"]
+        tile_cols = self.index["tile_cols"]
+        block, in_block = divmod(step, self.index["time_block"])
+
+        values = array.array('f')
+        for row in xrange(first_row, last_row + 1):
+            tile_row, in_tile = divmod(row, tile_rows)
+            for tile_col in xrange(first_col // tile_cols,
+                                   last_col // tile_cols + 1):
+                start = max(first_col - tile_col * tile_cols, 0)
+                end = min(last_col - tile_col * tile_cols, tile_cols - 1)
+                offset = self.chunk_offset(block, tile_row, tile_col) + \
+                         ((in_block * tile_rows + in_tile) * tile_cols +
+                          start) * 4
+                values.fromstring(self.mmap[offset:
+                                            offset + (end - start + 1) * 4])
+
+        return values
+
+    def get_step(self, step):
+        """ Returns all the values of one time step in file order. """
+        return self.read_box(step,
+                             0,
+                             self.index["rows"] - 1,
+                             0,
+                             self.index["points_per_row"] - 1)
+
+    def source_parser(self, source, parser_class=None):
+        """ Returns the parser of an ingested file, one of index["sources"],
+        with its data read from the cube.  If no parser_class is given the
+        one for the kind of file is used.
+
+        """
+        parser = gpcp_parsers.header_parser(str(source["header"]),
+                                            parser_class or
+                                            KIND_PARSERS[self.index["kind"]])
+        parser.data = GpcpCubeData(self, source["first_step"],
+                                   source["steps"])
+        return parser
+
+#------------------------------------------------------------------------------
+#     Main
+#------------------------------------------------------------------------------
+
+
+def main():
+    """ The 'main' function used to run the file/modules as a stand alone
+    application.
+
+    """
+    parser = argparse.ArgumentParser(description="Consolidates GPCP " + \
+                                     "files into cubes and writes CSV " + \
+                                     "files back out of them.")
+    commands = parser.add_subparsers(dest="command")
+
+    ingest_parser = commands.add_parser('ingest',
+                                        help="Ingest a directory of " + \
+                                             "GPCP files into a store.")
+    ingest_parser.add_argument('directory',
+                               help="The directory of GPCP files, sub " + \
+                                    "directories are included.")
+    ingest_parser.add_argument('store',
+                               help="The store directory to write, the " + \
+                                    "cubes in it are replaced.")
+    ingest_parser.add_argument('-t',
+                               '--time_block',
+                               default=str(TIME_BLOCK),
+                               help="The time steps per chunk, the " + \
+                                    "default is " + str(TIME_BLOCK) + ".")
+    ingest_parser.add_argument('-T',
+                               '--tile',
+                               default=str(TILE_ROWS) + "," + str(TILE_COLS),
+                               help="The rows,columns per chunk, the " + \
+                                    "default is " + str(TILE_ROWS) + "," + \
+                                    str(TILE_COLS) + ".")
+
+    export_parser = commands.add_parser('export',
+                                        help="Write the CSV file of " + \
+                                             "every file in a store.")
+    export_parser.add_argument('store',
+                               help="The store directory to read.")
+    export_parser.add_argument('-op',
+                               '--output_prefix',
+                               default="./",
+                               help="The output prefix as for " + \
+                                    "gpcp_to_csv, the year and for the " + \
+                                    "daily files the month are added.")
+    export_parser.add_argument('-f',
+                               '--format',
+                               default='3',
+                               help="The format option as for " + \
+                                    "gpcp_to_csv, the default is 3, the " + \
+                                    "one-line format of each kind of file.")
+    export_parser.add_argument('-J',
+                               '--step_jobs',
+                               default='1',
+                               help="As for gpcp_to_csv.")
+    export_parser.add_argument('-F',
+                               '--fixed_width',
+                               action='store_true',
+                               help="As for gpcp_to_csv.")
+    export_parser.add_argument('-P',
+                               '--prefix_cache',
+                               default="",
+                               help="As for gpcp_to_csv.")
+    args = parser.parse_args()
+
+    if args.command == "ingest":
+        tile_rows, tile_cols = [int(size) for size in args.tile.split(",")]
+        names = ingest(args.directory, args.store, int(args.time_block),
+                       tile_rows, tile_cols)
+        print("\nWrote " + str(len(names)) + " cubes to " + args.store + \
+              ": " + ", ".join(names) + "\n")
+
+    else:
+        format_opt = int(args.format)
+        if format_opt not in gpcp_to_csv.PARSERS:
+            parser.error("Please enter a format option of 0, 1, 2 or 3.")
+        if args.fixed_width and format_opt == 0:
+            parser.error("Please use -F with format 1, 2 or 3.")
+
+        written = export(args.store, args.output_prefix, format_opt,
+                         args.prefix_cache, int(args.step_jobs),
+                         args.fixed_width)
+        print("\nWrote " + str(written) + " CSV files.\n")
+
+#------------------------------------------------------------------------------
+#     Name
+#------------------------------------------------------------------------------
+
+
+if __name__ == '__main__':
+    main()
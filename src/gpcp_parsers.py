@@ -36,16 +36,440 @@ Notes/Lessons Learned
 from __future__ import print_function
 
 # Built-in/Batteries included Libraries
-import cStringIO    # Provides a way write to a memory file and then dump to
-                    # the file all at once rather than one line at a time.
-                    # This has proven to be faster than using the CSV writer.
+import array
+import cStringIO
 import csv
 import datetime
-import struct
+import mmap
+import sys
 
 # External Libraries
 import mapping
 
+# Stands in for the date in the CSV templates, see GpcpParser.generate_template
+DATE_MARK = "#"
+
+# Stands in for the day index in the star schema templates, see day_index.
+DAY_MARK = "@"
+
+# The columns a star schema fact row can be made of, see GpcpParser.columns.
+STAR_COLUMNS = ("date", "day_index", "cell_id", "value")
+DEFAULT_STAR_COLUMNS = "date,cell_id,value"
+
+# The fixed-width records, every field zero padded so every line has the same
+# length: YYYYMMDD,-LLL.LL,-LLL.LL,-VVVVV.VV and a new line.
+FIXED_PREFIX_FORMAT = "%07.2f,%07.2f,"
+FIXED_VALUE_FORMAT = "%09.2f"
+FIXED_RECORD_SIZE = 35
+
+# The CSV templates already built, keyed by the grid specification and if
+# they are fixed-width.
+_TEMPLATES = {}
+
+
+#------------------------------------------------------------------------------
+#     Functions
+#------------------------------------------------------------------------------
+
+
+def decode(packed):
+    """ Decodes a string of packed 4 byte floats into an array of floats. """
+    values = array.array('f')
+    values.fromstring(packed)
+
+    # Per the documentation from GPCP in the file structure the floats are
+    # -- big-endian -- so swap them on little-endian machines.
+    if sys.byteorder == "little":
+        values.byteswap()
+
+    return values
+
+
+def format_step(template, the_date, values):
+    """ Renders the CSV text of a whole time step in one go.  The date is put
+    into the template and then every value is formatted into it by a single
+    string formatting operation.
+
+    """
+    return template.replace(DATE_MARK, the_date) % tuple(values)
+
+
+def day_index(the_date):
+    """ Returns the number of days from 1970-01-01 to a YYYYMMDD date. """
+    return (datetime.datetime.strptime(the_date, "%Y%m%d").date() -
+            datetime.date(1970, 1, 1)).days
+
+
+def parse_columns(text):
+    """ Returns the tuple of star schema columns given as comma separated
+    names from STAR_COLUMNS, i.e. "day_index,cell_id,value".
+
+    Raises:
+        ValueError if a name is not a column, is given twice, or there is no
+        value column.
+
+    """
+    columns = tuple([name.strip() for name in text.split(",")])
+    for name in columns:
+        if name not in STAR_COLUMNS:
+            raise ValueError("The star schema columns are " + \
+                             ", ".join(STAR_COLUMNS) + ", not " + name + ".")
+
+    if len(set(columns)) != len(columns):
+        raise ValueError("A star schema column is given more than once.")
+    if "value" not in columns:
+        raise ValueError("The star schema columns must include value.")
+
+    return columns
+
+
+def fixed_offset(step, row, col, points_per_row, rows):
+    """ Returns the byte offset of the record of a cell in a fixed-width CSV
+    file, see GpcpParser.fixed_width.  A reader can seek straight to it.
+
+    """
+    return FIXED_RECORD_SIZE * \
+           ((step * rows + row) * points_per_row + col)
+
+
+def box_ranges(slices, points_per_row):
+    """ Returns the (offset, size) in bytes from the start of a time step of
+    each range of packed floats that holds the cells of the slices from
+    mapping.box_slices, ranges that touch are joined.
+
+    """
+    first_row, last_row, runs = slices
+    ranges = []
+    for row in xrange(first_row, last_row + 1):
+        for first_col, last_col in runs:
+            offset = (row * points_per_row + first_col) * 4
+            size = (last_col - first_col + 1) * 4
+            if ranges and sum(ranges[-1]) == offset:
+                ranges[-1] = (ranges[-1][0], ranges[-1][1] + size)
+            else:
+                ranges.append((offset, size))
+
+    return ranges
+
+
+def cell_ranges(cells):
+    """ Returns the (offset, size) in bytes from the start of a time step of
+    each range of packed floats that holds the cells, given by their index
+    in file order, as for box_ranges.
+
+    """
+    ranges = []
+    for cell in sorted(set(cells)):
+        if ranges and sum(ranges[-1]) == cell * 4:
+            ranges[-1] = (ranges[-1][0], ranges[-1][1] + 4)
+        else:
+            ranges.append((cell * 4, 4))
+
+    return ranges
+
+
+def read_ranges(handle, base, ranges):
+    """ Reads the ranges from box_ranges of the time step starting at byte
+    base of handle, seeking past everything else, and returns their values
+    decoded.  Streams such as gzip files can only seek forward, so the time
+    steps must be read in order.
+
+    Raises:
+        IOError if the data ends before the last range.
+
+    """
+    packed = []
+    for offset, size in ranges:
+        handle.seek(base + offset)
+        packed.append(handle.read(size))
+        if len(packed[-1]) < size:
+            raise IOError("The data ends inside the time step.")
+
+    return decode("".join(packed))
+
+
+def read_header(handle):
+    """ Reads the header record from the start of handle without reading any
+    further.  Every GPCP header starts with size=(char*N) where N is the size
+    of the header record in bytes.
+
+    Returns:
+        The header as a string.
+
+    Raises:
+        IOError if the start of handle is not a GPCP header.
+
+    """
+    header = ""
+    while not header.endswith(")") and len(header) < 32:
+        char = handle.read(1)
+        if not char:
+            break
+        header += char
+
+    if not (header.startswith("size=(char*") and header.endswith(")")):
+        raise IOError("No GPCP header found.")
+
+    header_size = int(header[len("size=(char*"):-1])
+    return header + handle.read(header_size - len(header))
+
+
+def detect_parser(header):
+    """ Detects the kind of GPCP file from its header.
+
+    Returns:
+        GpcpParserNewOneLine for the daily 1DD files, which have days=, and
+        GpcpParserOriginalOneLine for the monthly v2.x files, which have
+        months=.
+
+    Raises:
+        IOError if the header is of neither kind.
+
+    """
+    for item in header.split(" "):
+        if item.startswith("days="):
+            return GpcpParserNewOneLine
+        elif item.startswith("months="):
+            return GpcpParserOriginalOneLine
+
+    raise IOError("Unknown GPCP file, no days= or months= in the header.")
+
+
+def header_parser(header, parser_class=None, box=None):
+    """ Returns a parser with the variables of header but no data, used to
+    format data that was read and decoded elsewhere.  If no parser_class is
+    given the kind of file is detected from the header with detect_parser.
+    box is as for GpcpParser.
+
+    """
+    if parser_class is None:
+        parser_class = detect_parser(header)
+
+    return parser_class(cStringIO.StringIO(header), header=header, box=box)
+
+
+def open_parser(filename, lazy=False, parser_class=None, box=None):
+    """ Opens filename, or an open binary file or stream, once and returns
+    the parser for it.  If no parser_class is given the kind of file is
+    detected from the header with detect_parser.  A handle given is left
+    open for the caller to close.  box is as for GpcpParser.
+
+    Raises:
+        IOError if the file can not be opened or has no GPCP header.
+        ValueError if no cell of the grid is in box.
+
+    """
+    if hasattr(filename, "read"):
+        header = read_header(filename)
+        if parser_class is None:
+            parser_class = detect_parser(header)
+
+        return parser_class(filename, lazy=lazy, header=header, box=box)
+
+    with open(filename, 'rb') as handle:
+        header = read_header(handle)
+        if parser_class is None:
+            parser_class = detect_parser(header)
+
+        return parser_class(handle, lazy=lazy, header=header, box=box)
+
+#------------------------------------------------------------------------------
+#     Class:  GpcpData
+#------------------------------------------------------------------------------
+
+
+class GpcpData(object):
+    """ The decoded data of a GPCP file held in one flat array of 4 byte
+    floats with the shape (time steps, rows, points_per_row).  A time step is
+    a month for the monthly files and a day for the daily files.
+
+    Iterating over the object gives the rows, in file order, as array slices
+    so the parsers can keep working row by row.
+
+    """
+    def __init__(self, values, steps, rows, points_per_row):
+        """ The initialization function for an object. """
+        self.values = values
+        self.shape = (steps, rows, points_per_row)
+
+    @classmethod
+    def from_stream(cls, handle, points_per_row, rows):
+        """ Reads and decodes the packed big-endian floats of the data section
+        of a file from handle, a plain file or a decompressing stream such as
+        a gzip file, one time step sized block at a time.  An incomplete time
+        step at the end of a truncated file is ignored.
+
+        """
+        step_size = points_per_row * rows * 4
+        steps = 0
+
+        values = array.array('f')
+        while True:
+            packed = handle.read(step_size)
+            if len(packed) < step_size:
+                break
+
+            values.fromstring(packed)
+            steps += 1
+
+        # Per the documentation from GPCP in the file structure the floats
+        # are -- big-endian -- so swap them on little-endian machines.
+        if sys.byteorder == "little":
+            values.byteswap()
+
+        return cls(values, steps, rows, points_per_row)
+
+    @classmethod
+    def from_ranges(cls, handle, offset, step_size, ranges, cells):
+        """ Reads and decodes only the byte ranges from box_ranges of every
+        time step after the header of offset bytes, seeking past the rest.
+        The data is held as time steps of a single row of the cells in the
+        ranges.  An incomplete time step at the end of a truncated file is
+        ignored.
+
+        """
+        steps = 0
+        values = array.array('f')
+        while True:
+            try:
+                values.extend(read_ranges(handle,
+                                          offset + steps * step_size,
+                                          ranges))
+            except IOError:
+                break
+
+            steps += 1
+
+        return cls(values, steps, 1, cells)
+
+    def __len__(self):
+        """ Returns the number of rows held. """
+        return self.shape[0] * self.shape[1]
+
+    def __iter__(self):
+        """ Iterates over the rows in file order. """
+        for idx in xrange(len(self)):
+            yield self.get_row(idx)
+
+    def get_row(self, idx):
+        """ Returns the row at idx, counting across all time steps. """
+        points_per_row = self.shape[2]
+        return self.values[idx * points_per_row:(idx + 1) * points_per_row]
+
+    def get_step(self, step):
+        """ Returns all the values of one time step as a flat array. """
+        step_size = self.shape[1] * self.shape[2]
+        return self.values[step * step_size:(step + 1) * step_size]
+
+    def close(self):
+        """ Releases the data.  Nothing to do for data held in memory. """
+        pass
+
+#------------------------------------------------------------------------------
+#     Class:  GpcpLazyData
+#------------------------------------------------------------------------------
+
+
+class GpcpLazyData(GpcpData):
+    """ The data of a GPCP file memory mapped and only decoded one time step
+    at a time when it is touched.  Opening costs about the same as reading
+    the header and only the pages of the requested time steps are read from
+    disk.
+
+    """
+    def __init__(self, handle, offset, points_per_row, rows):
+        """ The initialization function for an object.  The handle must be a
+        real file opened in binary mode, offset is the size of the header.
+
+        """
+        self.mmap = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+        self.offset = offset
+
+        step_size = points_per_row * rows * 4
+        steps = max(len(self.mmap) - offset, 0) // step_size
+        GpcpData.__init__(self, None, steps, rows, points_per_row)
+
+        # The last decoded time step, rows are usually asked for in order.
+        self._step = (None, None)
+
+    def get_view(self, step):
+        """ Returns a zero-copy view of the packed big-endian floats of one
+        time step.
+
+        """
+        step_size = self.shape[1] * self.shape[2] * 4
+        return buffer(self.mmap, self.offset + step * step_size, step_size)
+
+    def get_row(self, idx):
+        """ Returns the row at idx, counting across all time steps. """
+        step, row = divmod(idx, self.shape[1])
+        points_per_row = self.shape[2]
+        return self.get_step(step)[row * points_per_row:
+                                   (row + 1) * points_per_row]
+
+    def get_step(self, step):
+        """ Decodes and returns all the values of one time step. """
+        if self._step[0] != step:
+            self._step = (step, decode(str(self.get_view(step))))
+
+        return self._step[1]
+
+    def close(self):
+        """ Unmaps the file. """
+        self._step = (None, None)
+        self.mmap.close()
+
+#------------------------------------------------------------------------------
+#     Class:  GpcpStreamData
+#------------------------------------------------------------------------------
+
+
+class GpcpStreamData(GpcpData):
+    """ The data of a GPCP file read forward from a stream, such as a gzip
+    file, one time step at a time.  The number of time steps is the one
+    declared in the header and the time steps must be asked for in order.
+    Unlike GpcpLazyData there is nothing to view without reading it.
+
+    """
+    def __init__(self, handle, steps, points_per_row, rows):
+        """ The initialization function for an object.  The handle must be
+        positioned just after the header and stay open while the data is
+        used, it is not closed by close().
+
+        """
+        GpcpData.__init__(self, None, steps, rows, points_per_row)
+        self.handle = handle
+        self._step = (-1, None)
+
+    def get_row(self, idx):
+        """ Returns the row at idx, counting across all time steps, the rows
+        must be asked for in order.
+
+        """
+        step, row = divmod(idx, self.shape[1])
+        points_per_row = self.shape[2]
+        return self.get_step(step)[row * points_per_row:
+                                   (row + 1) * points_per_row]
+
+    def get_step(self, step):
+        """ Reads, decodes and returns the values of the next time step. """
+        if step == self._step[0] + 1:
+            step_size = self.shape[1] * self.shape[2] * 4
+            packed = self.handle.read(step_size)
+            if len(packed) < step_size:
+                raise IOError("The data ends before time step " + \
+                              str(step + 1) + " of " + str(self.shape[0]))
+
+            self._step = (step, decode(packed))
+
+        elif step != self._step[0]:
+            raise ValueError("Streamed data can only be read in order.")
+
+        return self._step[1]
+
+    def close(self):
+        """ Drops the last time step, the handle is left to the caller. """
+        self._step = (None, None)
 
 #------------------------------------------------------------------------------
 #     Base Class:  GpcpParser
@@ -54,105 +478,281 @@ import mapping
 
 class GpcpParser(object):
     """ The master interface/abstract class should only be inherited from. """
-    def __init__(self, filename):
-        """ The initialization function for an object. """
+    # The directory the "lat,lon," text of each grid is kept in between
+    # runs, None renders it once per process.
+    prefix_cache_dir = None
+
+    # Set to True to write the one-line formats as fixed-width records of
+    # FIXED_RECORD_SIZE bytes, see fixed_offset.
+    fixed_width = False
+
+    # Set to a tuple from parse_columns to write star schema fact rows, the
+    # cell_id in place of the latitude and longitude, see generate_template.
+    columns = None
+
+    def __init__(self, filename, lazy=False, header=None, box=None):
+        """ The initialization function for an object.  filename is either
+        the name of a file or an open binary file or stream, such as a gzip
+        file, positioned at the start of the header.  Handles are read
+        forward only and left open for the caller to close.  If the header
+        has already been read from the handle, pass it as header.
+
+        If lazy is True each time step is only decoded when it is used, files
+        are memory mapped and streams are read one time step at a time.  Call
+        close() once done with the parser.
+
+        If box, a (south, west, north, east) from mapping.parse_bbox, is
+        given only the cells whose centers are in it are read, the rows
+        outside it are seeked past and never read or decoded.  The data then
+        holds a single row of those cells per time step, lazy is not used as
+        only the box is held.
+
+        """
         # Ensure data and header variables are reset, critical for looping
         # over a GpcpParser.
-        self.data = []
+        self.data = GpcpData(array.array('f'), 0, 0, 0)
         self.header = ""
+        self.box = box
+        self.slices = None
+        is_handle = hasattr(filename, "read")
 
         try:
-            # Open the file to get the first line of text
-            with open(filename, 'r') as get_firstline:
-                first_line = get_firstline.readline()
+            # Open the file only once, in binary, the header record is read
+            # first and then the handle is used to get the data.
+            if is_handle:
+                handle = filename
+            else:
+                handle = open(filename, 'rb')
 
-            # Open the file in binary, handle is then used to get the data
-            handle = open(filename, 'rb')
+            if header is None:
+                header = read_header(handle)
 
         except IOError, error:
             print("\nIOError: ", error)
-            print("Skipping file: " + filename + "\n")
+            print("Skipping file: " + getattr(filename, "name", filename) + \
+                  "\n")
 
         else:
-            # Get the variables from the first line of the file
-            self.variables = self.get_variables(first_line)
-            if self.variables == 0:
-                return
-
-            # Read the data from the file given the above variables
-            self.header = handle.read(int(self.variables["row_size"]))
-            things_per_row = \
-                int(self.variables["row_size"]) / \
-                int(self.variables["thing_size"])
-
-            # Per the documentation from GPCP in the file structure
-            # the floats are -- big-endian --
-            # Per python documentation struct uses ">" to determine
-            # byte order.  "f" is for float
-            row_format = ">" + "f" * things_per_row
-            while True:
-                packed = handle.read(int(self.variables["row_size"]))
-                if packed:
-                    row = struct.unpack(row_format, packed)
-                    self.data.append(row)
-                else:
-                    break
+            try:
+                self.read_data(handle, header, lazy)
+            finally:
+                if not is_handle:
+                    handle.close()
+
+    def read_data(self, handle, header, lazy):
+        """ Gets the variables from the header and reads the data after it
+        from handle.
+
+        """
+        # Get the variables from the header of the file
+        self.variables = self.get_variables(header)
+        if self.variables == 0:
+            return
+
+        self.header = header
+        points_per_row = int(self.variables["points_per_row"])
+
+        if self.box is not None:
+            self.slices = mapping.box_slices(*(self.grid_spec() + (self.box,)))
+            self.cells = mapping.box_cells(self.slices, points_per_row)
+            self.data = GpcpData.from_ranges(handle,
+                                             len(header),
+                                             self.rows_per_step() *
+                                             points_per_row * 4,
+                                             box_ranges(self.slices,
+                                                        points_per_row),
+                                             len(self.cells))
+
+        # Read the rest of the file in bulk, decoding it in one go is much
+        # faster than unpacking one row at a time into tuples of Python
+        # floats.  Only real files can be memory mapped.
+        elif lazy and isinstance(handle, file):
+            self.data = GpcpLazyData(handle,
+                                     len(header),
+                                     points_per_row,
+                                     self.rows_per_step())
+        elif lazy:
+            self.data = GpcpStreamData(handle,
+                                       self.declared_steps(),
+                                       points_per_row,
+                                       self.rows_per_step())
+        else:
+            self.data = GpcpData.from_stream(handle,
+                                             points_per_row,
+                                             self.rows_per_step())
 
-            handle.close()
+    def close(self):
+        """ Releases the data, needed for parsers opened with lazy=True,
+        even when the file holds no whole time step.
+
+        """
+        self.data.close()
 
     def has_data(self):
         """ Returns True if there is data in self.data, False otherwise. """
         return len(self.data) > 0
 
+    def declared_steps(self):
+        """ Returns the number of time steps the header declares. """
+        return int(self.variables["dimensions"].split("x")[3].strip(")"))
+
+    def declared_range(self):
+        """ Returns the (first, last) month or day the header declares as
+        published, from its months= or days= range.
+
+        """
+        if self.variables.get("start_month", "") != "":
+            return (int(self.variables["start_month"]),
+                    int(self.variables["end_month"]))
+
+        return int(self.variables["start_day"]), int(self.variables["end_day"])
+
+    def iter_steps(self):
+        """ Yields (step, values) for every time step in the file.  Only one
+        time step is decoded at a time when the parser was opened lazily.
+
+        """
+        for step in xrange(self.data.shape[0]):
+            yield step, self.data.get_step(step)
+
+    def rows_per_step(self):
+        """ Returns the number of rows in one time step, i.e. a month for the
+        monthly files and a day for the daily files.
+
+        """
+        if self.variables.get("rows_per_month", "") != "":
+            return int(self.variables["rows_per_month"])
+
+        return int(self.variables["rows_per_day"])
+
+    def cells_per_step(self):
+        """ Returns the number of cells written for each time step, those in
+        the box if there is one.
+
+        """
+        if self.slices is not None:
+            return len(self.cells)
+
+        return self.rows_per_step() * int(self.variables["points_per_row"])
+
     def generate_map(self):
-        """ Generates the needed map and returns it. """
-        pstr = self.header[self.header.index('1st_box_center'):]
-        start_pstr = mapping.LatLon(*[mapping.Coord(p) \
-                         for p in pstr[pstr.index('(') + \
-                                       1:pstr.index(')')].split(',')])
+        """ Returns the signed decimal (latitude, longitude) of every cell of
+        a time step in file order.  It is computed straight from the box
+        centers in the header and shared by every file on the same grid.
 
-        pstr = pstr[pstr.index('2nd_box_center'):]
-        next_pstr = mapping.LatLon(*[mapping.Coord(p) \
-                        for p in pstr[pstr.index('(') + \
-                                      1:pstr.index(')')].split(',')])
+        """
+        return mapping.coordinate_table(*self.grid_spec())
 
-        pstr = pstr[pstr.index('last_box_center'):]
-        end_pstr = mapping.LatLon(*[mapping.Coord(p) \
-                       for p in pstr[pstr.index('(') + \
-                                     1:pstr.index(')')].split(',')])
-
-        if self.variables["rows_per_month"] != '':
-            rows_per = int(self.variables["rows_per_month"])
-        elif self.variables["rows_per_day"] != '':
-            rows_per = int(self.variables["rows_per_day"])
-
-        coords = mapping.GeoMap(start_pstr,
-                                next_pstr,
-                                end_pstr,
-                                int(self.variables["points_per_row"]),
-                                rows_per)
-
-        # This is where some math using 1st_box_center should be done to
-        # determine the correct value to add/subtract.  For the current
-        # files being used it is 360, but this might not always be the case.
-        coords_map = []
-        for line in coords.map:
-            for coord in line:
-                latitude, longitude = str(coord).split(" ")
-                if latitude[-1] == "S":
-                    latitude = float("-" + latitude[:-1])
-                else:
-                    latitude = float(latitude[:-1])
+    def generate_prefixes(self):
+        """ Returns the "lat,lon," text of every cell of a time step in file
+        order, see generate_map.  Rendered once per grid and shared.
 
-                longitude = float(longitude[:-1])
-                if longitude < 180:
-                    longitude = longitude
+        """
+        if self.fixed_width:
+            prefix_format = FIXED_PREFIX_FORMAT
+        else:
+            prefix_format = None
+
+        return mapping.coordinate_prefixes(*self.grid_spec(),
+                                           cache_dir=self.prefix_cache_dir,
+                                           prefix_format=prefix_format)
+
+    def cell_prefixes(self):
+        """ Returns the "lat,lon," text of every cell written for a time
+        step, those in the box if there is one, in file order.
+
+        """
+        prefixes = self.generate_prefixes()
+        if self.slices is not None:
+            prefixes = [prefixes[cell] for cell in self.cells]
+
+        return prefixes
+
+    def value_format(self):
+        """ Returns the format each value is written with. """
+        if self.fixed_width:
+            return FIXED_VALUE_FORMAT
+
+        return "%4.2f"
+
+    def generate_template(self):
+        """ Returns the CSV text of a whole time step with DATE_MARK for the
+        date and "%4.2f" for each value, in file order.  Built once per grid
+        and shared.  With columns set each line is a star schema fact row of
+        those columns, DAY_MARK standing in for the day index.
+
+        The "%4.2f" is for floating point, it rounds correctly and if more
+        decimal places are needed change the 2 to a higher number.  Fixed
+        width templates use FIXED_VALUE_FORMAT instead.
+
+        """
+        key = (self.grid_spec(), self.fixed_width, self.slices, self.columns)
+        if key not in _TEMPLATES:
+            value_format = self.value_format()
+            if self.columns is None:
+                _TEMPLATES[key] = "".join([DATE_MARK + "," + prefix +
+                                           value_format + "\n"
+                                           for prefix in self.cell_prefixes()])
+            else:
+                fields = {"date": DATE_MARK,
+                          "day_index": DAY_MARK,
+                          "value": value_format}
+                if self.slices is not None:
+                    cells = self.cells
                 else:
-                    longitude = longitude - 360
+                    cells = xrange(self.cells_per_step())
+
+                _TEMPLATES[key] = "".join([",".join([str(cell)
+                                                     if name == "cell_id"
+                                                     else fields[name]
+                                                     for name in self.columns])
+                                           + "\n" for cell in cells])
+
+        return _TEMPLATES[key]
+
+    def fill_step(self, template, step, values):
+        """ Returns the CSV text of a time step from the template of
+        generate_template.
+
+        """
+        the_date = self.step_date(step)
+        if self.columns is not None and "day_index" in self.columns:
+            template = template.replace(DAY_MARK, str(day_index(the_date)))
+
+        return format_step(template, the_date, values)
+
+    def check_step(self, text):
+        """ Returns the CSV text of a time step after checking every record
+        of a fixed-width step has the same length.
+
+        Raises:
+            ValueError if a value is too wide for the fixed-width records.
 
-                coords_map.append([latitude, longitude])
+        """
+        if self.fixed_width and \
+           len(text) != FIXED_RECORD_SIZE * self.cells_per_step():
+            raise ValueError("A value is too wide for the fixed-width " + \
+                             "records.")
 
-        return coords_map
+        return text
+
+    def step_offset(self, step):
+        """ Returns the byte offset of a time step in a fixed-width CSV. """
+        return fixed_offset(step, 0, 0, self.cells_per_step(), 1)
+
+    def grid_spec(self):
+        """ Returns the grid of the file as a tuple of (the (lat, lon) of the
+        first box center, the grid spacing, points_per_row, rows).
+
+        """
+        start = self.variables["1st_box_center"]
+        second = self.variables["2nd_box_center"]
+        delta = max(abs(start[0] - second[0]), abs(start[1] - second[1]))
+
+        return (start,
+                delta,
+                int(self.variables["points_per_row"]),
+                self.rows_per_step())
 
     @staticmethod
     def get_variables(first_line):
@@ -174,9 +774,10 @@ class GpcpParser(object):
 
 class GpcpParserOriginal(GpcpParser):
     """ The orginial format map, month of data, month of data, etc. """
-    def __init__(self, filename):
+    def __init__(self, filename, lazy=False, header=None, box=None):
         """ The initialization function for an object. """
-        GpcpParser.__init__(self, filename=filename)
+        GpcpParser.__init__(self, filename=filename, lazy=lazy, header=header,
+                            box=box)
 
     def generate_map(self):
         """ overwrite the generate map written for single line entries """
@@ -277,7 +878,7 @@ class GpcpParserOriginal(GpcpParser):
                                quoting=csv.QUOTE_MINIMAL)
         coords = self.generate_map()
         outwriter.writerow(["MAP", ])
-        for line in coords.map:
+        for line in coords.iter_rows():
             outwriter.writerow(line)
 
         for idx, row in enumerate(self.data):
@@ -301,9 +902,10 @@ class GpcpParserOriginalOneLine(GpcpParser):
             19960101,88.75,0.75,0.19
 
     """
-    def __init__(self, filename):
+    def __init__(self, filename, lazy=False, header=None, box=None):
         """ The initialization function for an object. """
-        GpcpParser.__init__(self, filename=filename)
+        GpcpParser.__init__(self, filename=filename, lazy=lazy, header=header,
+                            box=box)
 
     @staticmethod
     def get_variables(first_line):
@@ -378,43 +980,37 @@ class GpcpParserOriginalOneLine(GpcpParser):
 
         return variables
 
+    def format_steps(self, steps):
+        """ Formats each (step, values) pair from steps into the CSV text for
+        that month.  A generator so only one month is held at a time.
+
+        """
+        template = self.generate_template()
+
+        for step, values in steps:
+            # Each row of requested output should be:
+            # data, lat, lon, value
+            yield self.check_step(self.fill_step(template, step, values))
+
+    def step_date(self, step):
+        """ Returns the YYYYMMDD date written for a time step, the first of
+        its month.
+
+        """
+        arbitrary_date = datetime.date(int(self.variables['year']),
+                                       step + 1,
+                                       01)
+        return (self.variables["year"] + \
+                arbitrary_date.strftime("%m") + \
+                "01")
+
     def write_csv(self, handle):
-        """ Writes out the csv data using the cStringIO module.  """
-        # Create a cStingIO object.  Write to the memory 'file' and then
-        # in the last line of the function write the entire memory 'file' to
-        # disk all at once.
-        file_str = cStringIO.StringIO()
-        coords = self.generate_map()
+        """ Writes out the csv data one month at a time so memory use is
+        bounded by a single month no matter the size of the file.
 
-        coord_pos = 0
-        for idx, row in enumerate(self.data):
-            if (idx % int(self.variables['rows_per_month']) == 0):
-                arbitrary_date = datetime.date(int(self.variables['year']),
-                             idx / int(self.variables['rows_per_month']) + 1,
-                             01)
-                the_date = (self.variables["year"] + \
-                            arbitrary_date.strftime("%m") + \
-                            "01")
-
-                # Reset to top of 'map' (i.e. the beginning of the coordinate
-                # list) at the beginning of each month.
-                coord_pos = 0
-
-            for element in row:
-                # The "$4.2f" is for floating point, it rounds correctly and
-                # if more decimal places are needed change the 2 to a higher
-                # number.
-                value = "%4.2f" % element
-
-                # Each row of requested output should be:
-                # data, lat, lon, value
-                file_str.write(str(the_date) + "," + \
-                               str(coords[coord_pos][0]) + "," + \
-                               str(coords[coord_pos][1]) + "," + \
-                               str(value) + "\n")
-                coord_pos += 1
-
-        handle.write(file_str.getvalue())
+        """
+        for chunk in self.format_steps(self.iter_steps()):
+            handle.write(chunk)
 
 #------------------------------------------------------------------------------
 #     Class:  GpcpParserNewOneLine
@@ -428,9 +1024,10 @@ class GpcpParserNewOneLine(GpcpParser):
             19960101,88.75,0.75,0.19
 
     """
-    def __init__(self, filename):
+    def __init__(self, filename, lazy=False, header=None, box=None):
         """ The initialization function for an object. """
-        GpcpParser.__init__(self, filename=filename)
+        GpcpParser.__init__(self, filename=filename, lazy=lazy, header=header,
+                            box=box)
 
     @staticmethod
     def get_variables(first_line):
@@ -503,40 +1100,31 @@ class GpcpParserNewOneLine(GpcpParser):
 
         return variables
 
+    def format_steps(self, steps):
+        """ Formats each (step, values) pair from steps into the CSV text for
+        that day.  A generator so only one day is held at a time.
+
+        """
+        template = self.generate_template()
+
+        for step, values in steps:
+            # Each row of requested output should be:
+            # data, lat, lon, value
+            yield self.check_step(self.fill_step(template, step, values))
+
+    def step_date(self, step):
+        """ Returns the YYYYMMDD date written for a time step, its day. """
+        arbitrary_date = datetime.date(int(self.variables['year']),
+                                       int(self.variables['month']),
+                                       step + 1)
+        return (self.variables["year"] + \
+                self.variables["month"] + \
+                arbitrary_date.strftime("%d"))
+
     def write_csv(self, handle):
-        """ Writes out the csv data using the cStringIO module.  """
-        # Create a cStingIO object.  Write to the memory 'file' and then
-        # in the last line of the function write the entire memory 'file' to
-        # disk all at once.
-        file_str = cStringIO.StringIO()
-        coords = self.generate_map()
+        """ Writes out the csv data one day at a time so memory use is
+        bounded by a single day no matter the size of the file.
 
-        coord_pos = 0
-        for idx, row in enumerate(self.data):
-            if (idx % int(self.variables['rows_per_day']) == 0):
-                arbitrary_date = datetime.date(int(self.variables['year']),
-                             int(self.variables['month']),
-                             idx / int(self.variables['rows_per_day']) + 1)
-                the_date = (self.variables["year"] + \
-                            self.variables["month"] + \
-                            arbitrary_date.strftime("%d"))
-
-                # Reset to top of 'map' (i.e. the beginning of the coordinate
-                # list) at the beginning of each month.
-                coord_pos = 0
-
-            for element in row:
-                # The "$4.2f" is for floating point, it rounds correctly and
-                # if more decimal places are needed change the 2 to a higher
-                # number.
-                value = "%4.2f" % element
-
-                # Each row of requested output should be:
-                # data, lat, lon, value
-                file_str.write(str(the_date) + "," + \
-                               str(coords[coord_pos][0]) + "," + \
-                               str(coords[coord_pos][1]) + "," + \
-                               str(value) + "\n")
-                coord_pos += 1
-
-        handle.write(file_str.getvalue())
+        """
+        for chunk in self.format_steps(self.iter_steps()):
+            handle.write(chunk)
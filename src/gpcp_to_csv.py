@@ -36,18 +36,33 @@ from __future__ import print_function
 
 # built-ins
 import argparse
+import collections
 import cProfile
 import datetime
 import gzip
 import logging
+import multiprocessing
 import os
 import pstats
 import StringIO
 import sys
 import time
+import traceback
 
 # external
+import array_cache
+import catalog
 import gpcp_parsers
+import manifest
+import mapping
+import pipeline
+import transpose
+
+# The parser for each format option, None detects it from the file header.
+PARSERS = {0: gpcp_parsers.GpcpParserOriginal,
+           1: gpcp_parsers.GpcpParserOriginalOneLine,
+           2: gpcp_parsers.GpcpParserNewOneLine,
+           3: None}
 
 #------------------------------------------------------------------------------
 #     Functions
@@ -160,12 +175,184 @@ def get_args():
                    "1 decodes MONTHLY GPCP (v2.2) binary data into CSV with " +
                    "a date/lat/lon value for each precip value in the file. " +
                    "One line per value.  2 decodes DAILY GPCP (v1.2) binary " +
-                   "file into same csv format as 1 above.")
+                   "file into same csv format as 1 above.  3 detects " +
+                   "MONTHLY or DAILY from the header of each file and " +
+                   "uses 1 or 2 above, it needs -s or -d.")
     parser.add_argument('-f',
                         '--format',
                         default='2',
                         help=format_help)
 
+    parser.add_argument('-d',
+                        '--input_dir',
+                        default="",
+                        help="A directory of input files to convert, " + \
+                             "used instead of the input prefix, years " + \
+                             "and months.  Every file in it (every .gz " + \
+                             "file if -z is set) is converted to the " + \
+                             "output prefix plus the file name plus .csv. " + \
+                             "Use -f 3 for a directory of mixed files.")
+
+    parser.add_argument('-c',
+                        '--catalog',
+                        default="",
+                        help="A catalog file written by catalog.py.  The " + \
+                             "files for the years and months asked for " + \
+                             "are then taken from the catalog instead of " + \
+                             "the input prefix and truncated files are " + \
+                             "skipped.  With -z the .gz files of the " + \
+                             "catalog are used, without it the others.")
+
+    parser.add_argument('-S',
+                        '--stream',
+                        action='store_true',
+                        help="Set this flag to memory map the input " + \
+                             "files and convert them one time step (month " + \
+                             "or day) at a time.  Memory use is then " + \
+                             "bounded by a single time step no matter how " + \
+                             "large the input file is.")
+
+    parser.add_argument('-j',
+                        '--jobs',
+                        default='1',
+                        help="The number of files to convert at the same " + \
+                             "time in separate processes.  The default " + \
+                             "is 1, one file after the other.")
+
+    parser.add_argument('-J',
+                        '--step_jobs',
+                        default='1',
+                        help="The number of processes to format the " + \
+                             "time steps (months or days) of each file " + \
+                             "with.  The pieces are written back in " + \
+                             "order to the one output file.  Not used " + \
+                             "for format 0 and can not be used with -j.")
+
+    parser.add_argument('-O',
+                        '--overlap',
+                        action='store_true',
+                        help="Set this flag to read, decode, format and " + \
+                             "write in separate threads so they overlap, " + \
+                             "the next file is read while the current " + \
+                             "one is written.  Only for formats 1, 2 and " + \
+                             "3 and can not be used with -j or -J.")
+
+    parser.add_argument('-A',
+                        '--in_flight',
+                        default='0',
+                        help="The number of files to open, read and " + \
+                             "write at the same time in threads, for " + \
+                             "batches on slow (network) disks.  With -J " + \
+                             "the formatting is done by a pool of that " + \
+                             "many processes shared by all the files.  " + \
+                             "Only for formats 1, 2 and 3 and can not be " + \
+                             "used with -j or -O.")
+
+    parser.add_argument('-F',
+                        '--fixed_width',
+                        action='store_true',
+                        help="Set this flag to write every line with the " + \
+                             "same length, the latitude, longitude and " + \
+                             "value zero padded, i.e. " + \
+                             "19960101,0089.50,0000.50,000000.19 so any " + \
+                             "day and cell can be found by its offset.  " + \
+                             "With -J the processes write their time " + \
+                             "steps straight into the output file.  Only " + \
+                             "for formats 1, 2 and 3.")
+
+    parser.add_argument('-P',
+                        '--prefix_cache',
+                        default="",
+                        help="A directory to keep the rendered latitude " + \
+                             "and longitude text of each grid in.  Later " + \
+                             "runs read it from there instead of " + \
+                             "rendering it again.")
+
+    parser.add_argument('-M',
+                        '--manifest',
+                        action='store_true',
+                        help="Set this flag to keep a manifest of the " + \
+                             "files converted in each output directory " + \
+                             "and skip the files that have not changed " + \
+                             "since they were last converted with the " + \
+                             "same options, so a stopped run can be " + \
+                             "started again where it left off.")
+
+    parser.add_argument('-I',
+                        '--incremental',
+                        action='store_true',
+                        help="Set this flag to only convert the months " + \
+                             "or days published since a file was last " + \
+                             "converted and add them to its output, for " + \
+                             "files that grow such as the current year.  " + \
+                             "Keeps a manifest as -M does.  Only for " + \
+                             "formats 1, 2 and 3 and can not be used with " + \
+                             "-J, -O or -A.")
+
+    parser.add_argument('-C',
+                        '--array_cache',
+                        default="",
+                        help="A directory to keep the decoded data of " + \
+                             "each input file in.  Files converted again, " + \
+                             "with other options, are memory mapped from " + \
+                             "there instead of being decoded again.  Can " + \
+                             "not be used with -O, -A or -I.")
+
+    parser.add_argument('--array_cache_size',
+                        default=str(array_cache.DEFAULT_SIZE),
+                        help="The size limit of the -C directory in " + \
+                             "megabytes, the least recently used files " + \
+                             "are removed to stay under it.  The default " + \
+                             "is " + str(array_cache.DEFAULT_SIZE) + ".")
+
+    parser.add_argument('-b',
+                        '--bbox',
+                        default="",
+                        help="Only read and write the cells inside the " + \
+                             "box S,W,N,E in signed decimal degrees, i.e. " + \
+                             "-b=-35,-20,38,52 (with the = if it starts " + \
+                             "with a minus).  A box with W greater than E " + \
+                             "crosses the 180 degree meridian.  Only for " + \
+                             "formats 1, 2 and 3 and can not be used with " + \
+                             "-O, -A, -I or -C.")
+
+    parser.add_argument('-T',
+                        '--cell_major',
+                        default="",
+                        help="Write every file of the batch to this one " + \
+                             "CSV file grouped by cell, all the dates of " + \
+                             "each cell together, instead of a CSV file " + \
+                             "per input file.  The files must be on the " + \
+                             "same grid.  Only for formats 1, 2 and 3 and " + \
+                             "can not be used with -j, -J, -O, -A, -M, -I " + \
+                             "or -C.")
+
+    parser.add_argument('--transpose_memory',
+                        default=str(transpose.DEFAULT_MEMORY),
+                        help="The memory in megabytes -T may hold in each " + \
+                             "pass, more is spilled to temporary files " + \
+                             "next to the output.  The default is " + \
+                             str(transpose.DEFAULT_MEMORY) + ".")
+
+    parser.add_argument('-K',
+                        '--star',
+                        action='store_true',
+                        help="Set this flag to write star schema fact " + \
+                             "rows, a cell_id in place of the latitude " + \
+                             "and longitude, and a cells_<points>x<rows>" + \
+                             ".csv table of cell_id,latitude,longitude," + \
+                             "row,col once per grid next to the output.  " + \
+                             "Only for formats 1, 2 and 3 and can not be " + \
+                             "used with -F, -O, -A, -I or -T.")
+
+    parser.add_argument('--columns',
+                        default=gpcp_parsers.DEFAULT_STAR_COLUMNS,
+                        help="The columns of the -K fact rows from " + \
+                             ", ".join(gpcp_parsers.STAR_COLUMNS) + \
+                             ", day_index being the days since 1970-01-01" + \
+                             ".  The default is " + \
+                             gpcp_parsers.DEFAULT_STAR_COLUMNS + ".")
+
     return parser.parse_args()
 
 #------------------------------------------------------------------------------
@@ -192,28 +379,181 @@ def check_args(args):
     years = args.years
     months = args.months
     format_opt = args.format
+    input_dir = args.input_dir
+    catalog_file = args.catalog
+    jobs = args.jobs
+
+    # options passed straight through to process_file
+    options = {"stream": args.stream,
+               "prefix_cache": args.prefix_cache,
+               "step_jobs": int(args.step_jobs),
+               "fixed_width": args.fixed_width,
+               "array_cache_dir": args.array_cache,
+               "array_cache_size": int(args.array_cache_size)}
+
+    if options["fixed_width"] and int(format_opt) == 0:
+        err_message = "Please use -F with format 1, 2 or 3."
+        error_help_then_exit(err_message)
+
+    if options["step_jobs"] < 1:
+        err_message = "Please enter 1 or more step jobs with -J."
+        error_help_then_exit(err_message)
+
+    if options["step_jobs"] > 1 and int(jobs) > 1:
+        err_message = "Please use either -j or -J, not both."
+        error_help_then_exit(err_message)
+
+    if args.overlap:
+        if options["step_jobs"] > 1 or int(jobs) > 1:
+            err_message = "Please use -O without -j or -J."
+            error_help_then_exit(err_message)
+        if int(format_opt) == 0:
+            err_message = "Please use -O with format 1, 2 or 3."
+            error_help_then_exit(err_message)
+
+        options["overlap"] = True
+
+    if int(args.in_flight) > 0:
+        if args.overlap or int(jobs) > 1:
+            err_message = "Please use -A without -j or -O."
+            error_help_then_exit(err_message)
+        if int(format_opt) == 0:
+            err_message = "Please use -A with format 1, 2 or 3."
+            error_help_then_exit(err_message)
+
+        options["in_flight"] = int(args.in_flight)
+
+    if args.incremental:
+        if args.overlap or int(args.in_flight) > 0 or \
+           options["step_jobs"] > 1:
+            err_message = "Please use -I without -J, -O or -A."
+            error_help_then_exit(err_message)
+        if int(format_opt) == 0:
+            err_message = "Please use -I with format 1, 2 or 3."
+            error_help_then_exit(err_message)
+
+        options["incremental"] = True
+
+    if options["array_cache_dir"] != "":
+        if args.overlap or int(args.in_flight) > 0 or args.incremental:
+            err_message = "Please use -C without -O, -A or -I."
+            error_help_then_exit(err_message)
+        if not os.path.isdir(options["array_cache_dir"]):
+            err_message = "The array cache directory " + \
+                          options["array_cache_dir"] + " does not exist."
+            error_help_then_exit(err_message)
+
+    if args.bbox != "":
+        if args.overlap or int(args.in_flight) > 0 or args.incremental or \
+           options["array_cache_dir"] != "":
+            err_message = "Please use -b without -O, -A, -I or -C."
+            error_help_then_exit(err_message)
+        if int(format_opt) == 0:
+            err_message = "Please use -b with format 1, 2 or 3."
+            error_help_then_exit(err_message)
+        try:
+            mapping.parse_bbox(args.bbox)
+        except ValueError, error:
+            error_help_then_exit(str(error))
+
+        options["bbox"] = args.bbox
+
+    if args.cell_major != "":
+        if args.overlap or int(args.in_flight) > 0 or args.incremental or \
+           args.manifest or options["array_cache_dir"] != "" or \
+           options["step_jobs"] > 1 or int(jobs) > 1:
+            err_message = "Please use -T without -j, -J, -O, -A, -M, -I " + \
+                          "or -C."
+            error_help_then_exit(err_message)
+        if int(format_opt) == 0:
+            err_message = "Please use -T with format 1, 2 or 3."
+            error_help_then_exit(err_message)
+        if int(args.transpose_memory) < 1:
+            err_message = "Please enter 1 or more megabytes with " + \
+                          "--transpose_memory."
+            error_help_then_exit(err_message)
+
+        options["cell_major"] = args.cell_major
+        options["transpose_memory"] = int(args.transpose_memory)
+
+    if args.star:
+        if args.fixed_width or args.overlap or int(args.in_flight) > 0 or \
+           args.incremental or args.cell_major != "":
+            err_message = "Please use -K without -F, -O, -A, -I or -T."
+            error_help_then_exit(err_message)
+        if int(format_opt) == 0:
+            err_message = "Please use -K with format 1, 2 or 3."
+            error_help_then_exit(err_message)
+        try:
+            gpcp_parsers.parse_columns(args.columns)
+        except ValueError, error:
+            error_help_then_exit(str(error))
+
+        options["star_columns"] = args.columns
+
+    if args.manifest or args.incremental:
+        options["manifest"] = True
+
+    if options["prefix_cache"] != "" and \
+       not os.path.isdir(options["prefix_cache"]):
+        err_message = "The prefix cache directory " + \
+                      options["prefix_cache"] + " does not exist."
+        error_help_then_exit(err_message)
 
     if single_file:
-        # check for input_file and output_file
-        if input_file != "" and output_file != "":
+        # check for input_file and output_file, -T names the output itself
+        if input_file != "" and (output_file != "" or args.cell_major != ""):
             format_opt = int(format_opt)
 
             return (zipped,
                     input_file,
                     output_file,
-                    format_opt)
+                    format_opt,
+                    options)
         else:
             err_message = "For a single file, a input and output file " + \
                           "must be specified with the appropriate options."
             error_help_then_exit(err_message)
 
     else:  # multi_file options
+        jobs = int(jobs)
+        if jobs < 1:
+            err_message = "Please enter 1 or more jobs with -j."
+            error_help_then_exit(err_message)
+
         format_opt = int(format_opt)
-        if not(0 <= format_opt <= 2):
+        if not(0 <= format_opt <= 3):
             err_message = "Please enter an appropriate format option with " + \
                           "-f as in:  "
             error_help_then_exit(err_message)
 
+        if input_dir != "":
+            if not os.path.isdir(input_dir):
+                err_message = "The input directory " + input_dir + \
+                              " does not exist."
+                error_help_then_exit(err_message)
+
+            return (zipped,
+                    input_prefix,
+                    output_prefix,
+                    None,
+                    None,
+                    format_opt,
+                    input_dir,
+                    catalog_file,
+                    jobs,
+                    options)
+
+        if catalog_file != "" and not os.path.isfile(catalog_file):
+            err_message = "The catalog file " + catalog_file + \
+                          " does not exist."
+            error_help_then_exit(err_message)
+
+        if format_opt == 3 and catalog_file == "":
+            err_message = "Format 3 needs a single file (-s), an input " + \
+                          "directory (-d) or a catalog (-c)."
+            error_help_then_exit(err_message)
+
         years_list = []
         if "," in years:
             years_list = years.split(",")
@@ -243,7 +583,11 @@ def check_args(args):
                 output_prefix,
                 years_list,
                 months_list,
-                format_opt)
+                format_opt,
+                input_dir,
+                catalog_file,
+                jobs,
+                options)
 
 #------------------------------------------------------------------------------
 
@@ -261,51 +605,73 @@ def error_help_then_exit(message):
 #------------------------------------------------------------------------------
 
 
-def unzip(filename):
-    """ Unzips a gzip file for use.  If the file ends with .gz it decompresses
-    the file to the filename minus the .gz file extension.  If the file does
-    not end with .gz it adds _unzipped at the end of the file name.
-
-    Input:
-        The file name of a compressed file.  The file must be compressed using
-        gzip.
-
-    Returns:
-        The file name of the uncompressed file.
+def process_file(input_filename, output_filename, format_opt, zipped,
+                 stream=False, prefix_cache="", step_jobs=1, fixed_width=False,
+                 incremental=False, previous=None, array_cache_dir="",
+                 array_cache_size=array_cache.DEFAULT_SIZE, bbox="",
+                 star_columns=""):
+    """ Extracts the data from the input file and saves it in CSV format in
+    the output file in the format specified by the format option.  If the file
+    is zipped it is decompressed as it is read, nothing is written next to the
+    input file.  If stream is True the input file is memory mapped, or for a
+    zipped file streamed, and converted one time step at a time.  If a
+    prefix_cache directory is given the coordinate text of the grid is kept
+    there between runs.  If step_jobs is more than 1 the time steps are
+    formatted by that many processes, see write_csv_split.  If fixed_width
+    is True every line is written with the same length, see write_fixed_split
+    for how that is used with step_jobs.  If incremental is True the file is
+    converted by append_file with previous as its manifest entry and what
+    append_file returns is returned.  If an array_cache_dir is given the
+    decoded data is kept there, up to array_cache_size megabytes, and memory
+    mapped from there the next time the same file is converted.  If a bbox
+    of S,W,N,E is given only the cells in it are read and written, see
+    mapping.parse_bbox.  If star_columns are given, i.e. "date,cell_id,value",
+    star schema fact rows of those columns are written instead of lat,lon
+    lines, see write_cells_table.
 
     """
-    if filename.endswith(".gz"):
-        return_filename = filename[:-3]
-    else:
-        return_filename = filename + "_unzipped"
-
-    try:
-        z_content = gzip.open(filename, 'rb')
-        print("\nExtracting data from: ", filename)
-        with open(return_filename, 'wb') as uncompressed:
-            uncompressed.write(z_content.read())
+    if format_opt not in PARSERS:
+        err_message = "An incorrect format was entered please enter a " + \
+                      "valid option of 0, 1, 2 or 3."
+        error_help_then_exit(err_message)
 
-    except IOError, error:
-        print("\nIOError from unzip: ", error)
-        raise
+    columns = None
+    if star_columns != "":
+        columns = gpcp_parsers.parse_columns(star_columns)
 
-    else:
-        return return_filename
+    if incremental:
+        return append_file(input_filename, output_filename, format_opt,
+                           zipped, previous, prefix_cache, fixed_width)
 
-#------------------------------------------------------------------------------
+    if array_cache_dir != "":
+        try:
+            the_cache = array_cache.ArrayCache(array_cache_dir,
+                                               array_cache_size)
+            parser = the_cache.open_parser(input_filename, zipped,
+                                           PARSERS[format_opt])
+        except IOError, error:
+            print("\nIOError: ", error)
+            print("Skipping file: " + input_filename + "\n")
+            return 0
 
+        try:
+            write_output(parser, output_filename, prefix_cache, step_jobs,
+                         fixed_width, columns)
+        except (IOError, ValueError), error:
+            print("\n" + error.__class__.__name__ + ": ", error)
+            print("Skipping file: " + input_filename + "\n")
+            parser.close()
+            return 0
 
-def process_file(input_filename, output_filename, format_opt, zipped):
-    """ Extracts the data from the input file and saves it in CSV format in
-    the output file in the format specified by the format option.  If the file
-    is zipped it is decompressed first.
+        return 1
 
-    """
     if zipped:
         try:
-            input_file = unzip(input_filename)
+            input_file = gzip.open(input_filename, 'rb')
+            print("\nExtracting data from: ", input_filename)
 
-        except IOError:
+        except IOError, error:
+            print("\nIOError from gzip: ", error)
             err_message = "Skipping file: " + input_filename + "\n"
             print(err_message)
             return 0
@@ -313,26 +679,451 @@ def process_file(input_filename, output_filename, format_opt, zipped):
     else:
         input_file = input_filename
 
-    if format_opt == 0:
-        parser = gpcp_parsers.GpcpParserOriginal(input_file)
-    elif format_opt == 1:
-        parser = gpcp_parsers.GpcpParserOriginalOneLine(input_file)
-    elif format_opt == 2:
-        parser = gpcp_parsers.GpcpParserNewOneLine(input_file)
-    else:
-        err_message = "An incorrect format was entered please enter a " + \
-                      "valid option of 0, 1, or 2."
-        error_help_then_exit(err_message)
+    # The file is opened once, the header is read and the rest of the file
+    # is read by the parser for the format given or detected.
+    try:
+        box = None
+        if bbox != "":
+            box = mapping.parse_bbox(bbox)
+
+        parser = gpcp_parsers.open_parser(input_file,
+                                          lazy=stream,
+                                          parser_class=PARSERS[format_opt],
+                                          box=box)
+
+    except (IOError, ValueError), error:
+        print("\n" + error.__class__.__name__ + ": ", error)
+        print("Skipping file: " + input_filename + "\n")
+        if zipped:
+            input_file.close()
+        return 0
+
+    # Streamed data is only read as it is written, a truncated or corrupt
+    # file is found here.
+    try:
+        write_output(parser, output_filename, prefix_cache, step_jobs,
+                     fixed_width, columns)
+    except (IOError, ValueError), error:
+        print("\n" + error.__class__.__name__ + ": ", error)
+        print("Skipping file: " + input_filename + "\n")
+        parser.close()
+        return 0
+    finally:
+        if zipped:
+            input_file.close()
+
+    return 1
+
+#------------------------------------------------------------------------------
+
+
+def write_output(parser, output_filename, prefix_cache="", step_jobs=1,
+                 fixed_width=False, columns=None):
+    """ Writes the data of parser to output_filename for process_file, with
+    prefix_cache, step_jobs and fixed_width as for process_file and columns
+    from gpcp_parsers.parse_columns for star schema fact rows, then closes
+    the parser.
+
+    """
+    if prefix_cache != "":
+        parser.prefix_cache_dir = prefix_cache
+
+    parser.fixed_width = fixed_width
+    parser.columns = columns
 
     if parser.has_data():
-        with open(output_filename, 'w') as out_file:
-            print("Writing CSV value to ", output_filename)
-            parser.write_csv(out_file)
+        if columns is not None:
+            write_cells_table(parser,
+                              os.path.dirname(os.path.abspath(
+                                  output_filename)))
+
+        # The output is written under a partial name and only renamed once
+        # it is complete, so a crash never leaves half a file that looks
+        # complete.  Fixed-width files are written in binary so the line
+        # endings, and so the offsets, are the same on every platform.
+        part_filename = manifest.part_name(output_filename)
+        mode = 'wb' if fixed_width else 'w'
+        try:
+            with open(part_filename, mode) as out_file:
+                print("Writing CSV value to ", output_filename)
+                if step_jobs > 1 and fixed_width:
+                    write_fixed_split(parser, out_file, step_jobs,
+                                      prefix_cache)
+                elif step_jobs > 1 and hasattr(parser, "format_steps"):
+                    write_csv_split(parser, out_file, step_jobs, prefix_cache)
+                else:
+                    parser.write_csv(out_file)
 
-    if zipped:
-        os.remove(input_file)
+        except:
+            if os.path.exists(part_filename):
+                os.remove(part_filename)
+            raise
 
-    return 1
+        manifest.commit_output(output_filename)
+
+    parser.close()
+
+#------------------------------------------------------------------------------
+
+
+def write_cells_table(parser, directory):
+    """ Writes the dimension table of the grid of parser for the star schema
+    fact rows to directory, once per grid, as cells_<points_per_row>x<rows>.csv
+    with a line of cell_id,latitude,longitude,row,col for every cell.  The
+    cell_id is the index of the cell in file order.
+
+    Returns:
+        The name of the table.
+
+    """
+    start, delta, points_per_row, rows = parser.grid_spec()
+    table_name = os.path.join(directory,
+                              "cells_" + str(points_per_row) + "x" + \
+                              str(rows) + ".csv")
+    if os.path.exists(table_name):
+        return table_name
+
+    prefixes = mapping.coordinate_prefixes(start, delta, points_per_row,
+                                           rows)
+
+    def write(handle):
+        """ Writes a line for every cell. """
+        for cell, prefix in enumerate(prefixes):
+            row, col = divmod(cell, points_per_row)
+            handle.write(str(cell) + "," + prefix + str(row) + "," + \
+                         str(col) + "\n")
+
+    # Written with write_atomic, processes converting files of the same grid
+    # at the same time may both write it.
+    manifest.write_atomic(table_name, write, 'w')
+
+    return table_name
+
+#------------------------------------------------------------------------------
+
+
+def append_file(input_filename, output_filename, format_opt, zipped,
+                previous=None, prefix_cache="", fixed_width=False):
+    """ Converts a file that grows as months or days are published, only
+    decoding and formatting the time steps added since the output was last
+    written.  previous is the manifest entry of the output, the time steps
+    the header declared as published then are kept and the ones after them,
+    which hold missing values until they are published, are written again.
+    See manifest.resume_point for when the output is written from scratch
+    instead.
+
+    Returns:
+        0 if it failed, else a dictionary of the time steps now published,
+        the size of the output up to them and the whole output size for the
+        manifest entry of the output.
+
+    """
+    key = manifest.input_key(input_filename, format_opt, zipped,
+                             {"fixed_width": fixed_width})
+    wrote_part = False
+    try:
+        if zipped:
+            input_file = gzip.open(input_filename, 'rb')
+        else:
+            input_file = open(input_filename, 'rb')
+
+        try:
+            header = gpcp_parsers.read_header(input_file)
+            parser = gpcp_parsers.header_parser(header, PARSERS[format_opt])
+            if prefix_cache != "":
+                parser.prefix_cache_dir = prefix_cache
+            parser.fixed_width = fixed_width
+
+            fingerprint = manifest.header_fingerprint(header)
+            start, published = parser.declared_range()
+            step, settled_size = manifest.resume_point(previous,
+                                                       key,
+                                                       output_filename,
+                                                       fingerprint,
+                                                       (start, published))
+
+            # The time steps before step are already in the output, a gzip
+            # file still has to decompress them to get past them.
+            step_size = parser.rows_per_step() * \
+                        int(parser.variables["points_per_row"]) * 4
+            input_file.seek(len(header) + step * step_size)
+
+            if step > 0:
+                # A partial output left by an earlier run that was stopped
+                # is stale, it must never be renamed over this one.
+                if os.path.exists(manifest.part_name(output_filename)):
+                    os.remove(manifest.part_name(output_filename))
+
+                out_file = open(output_filename, 'r+b' if fixed_width
+                                                 else 'r+')
+                out_file.seek(settled_size)
+                out_file.truncate()
+                print("Appending CSV value to ", output_filename)
+            else:
+                out_file = open(manifest.part_name(output_filename),
+                                'wb' if fixed_width else 'w')
+                wrote_part = True
+                print("Writing CSV value to ", output_filename)
+
+            try:
+                while True:
+                    packed = input_file.read(step_size)
+                    if len(packed) < step_size:
+                        break
+
+                    values = gpcp_parsers.decode(packed)
+                    out_file.write("".join(parser.format_steps([(step,
+                                                                 values)])))
+                    step += 1
+                    if step <= published:
+                        settled_size = out_file.tell()
+
+                output_size = out_file.tell()
+
+            finally:
+                out_file.close()
+
+        finally:
+            input_file.close()
+
+    except (IOError, ValueError), error:
+        print("\n" + error.__class__.__name__ + ": ", error)
+        print("Skipping file: " + input_filename + "\n")
+        if os.path.exists(manifest.part_name(output_filename)):
+            os.remove(manifest.part_name(output_filename))
+        return 0
+
+    if wrote_part:
+        manifest.commit_output(output_filename)
+
+    return {"fingerprint": fingerprint,
+            "range_start": start,
+            "steps": min(step, published),
+            "settled_size": settled_size,
+            "output_size": output_size}
+
+#------------------------------------------------------------------------------
+
+
+def write_csv_split(parser, out_file, step_jobs, prefix_cache=""):
+    """ Writes out the csv data of a one-line parser with its time steps
+    formatted by a pool of step_jobs processes.  The time steps are decoded
+    in this process and the formatted pieces are written in order as they
+    come back, with at most pipeline.QUEUE_SIZE per process in flight so a
+    streamed file is not read ahead of the writing.
+
+    """
+    pool = multiprocessing.Pool(step_jobs)
+    try:
+        pending = collections.deque()
+        for step, values in parser.iter_steps():
+            pending.append(pool.apply_async(pipeline.format_step_job,
+                           ((parser.__class__, parser.header, prefix_cache,
+                             False, parser.box, parser.columns, step,
+                             values),)))
+            if len(pending) >= pipeline.QUEUE_SIZE * step_jobs:
+                out_file.write(pending.popleft().get())
+
+        while pending:
+            out_file.write(pending.popleft().get())
+
+    finally:
+        pool.close()
+        pool.join()
+
+#------------------------------------------------------------------------------
+
+
+def write_fixed_split(parser, out_file, step_jobs, prefix_cache=""):
+    """ Writes out the fixed-width csv data of a one-line parser with a pool
+    of step_jobs processes.  The output file is made its full size first and
+    each process then writes the time steps it formats straight into their
+    own part of the file, in whatever order they are done.  As in
+    write_csv_split at most pipeline.QUEUE_SIZE time steps per process are
+    in flight.
+
+    """
+    out_file.truncate(parser.step_offset(parser.data.shape[0]))
+    out_file.flush()
+
+    pool = multiprocessing.Pool(step_jobs)
+    try:
+        pending = collections.deque()
+        for step, values in parser.iter_steps():
+            pending.append(pool.apply_async(pipeline.write_step_job,
+                           ((parser.__class__, parser.header, prefix_cache,
+                             parser.box, out_file.name, step, values),)))
+            if len(pending) >= pipeline.QUEUE_SIZE * step_jobs:
+                pending.popleft().get()
+
+        while pending:
+            pending.popleft().get()
+
+    finally:
+        pool.close()
+        pool.join()
+
+#------------------------------------------------------------------------------
+
+
+def process_file_captured(job):
+    """ Runs process_file for a worker process of a pool with what it prints
+    captured so it can be printed in order by the main process.  Any error
+    is caught so one bad file can not take down the pool.
+
+    Input:
+        A tuple of (input_filename, output_filename, format_opt, zipped,
+        options) where options are the keyword options of process_file.
+
+    Returns:
+        A tuple of (result, output) where result is what process_file
+        returned, 0 if it failed, and output is what it printed.
+
+    """
+    input_filename, output_filename, format_opt, zipped, options = job
+
+    stdout = sys.stdout
+    sys.stdout = StringIO.StringIO()
+    try:
+        try:
+            result = process_file(input_filename,
+                                  output_filename,
+                                  format_opt,
+                                  zipped,
+                                  **options)
+        except (Exception, SystemExit):
+            traceback.print_exc(file=sys.stdout)
+            print("Skipping file: " + input_filename + "\n")
+            result = 0
+
+    finally:
+        output = sys.stdout.getvalue()
+        sys.stdout = stdout
+
+    return result, output
+
+#------------------------------------------------------------------------------
+
+
+def process_files(files, format_opt, zipped, jobs=1, options=None,
+                  pool=None):
+    """ Runs process_file for every (input_filename, output_filename) pair
+    in files, spread over a pool of jobs processes if jobs is more than 1.
+    A pool can be passed in to be used instead, it is left open so it can
+    be used again.  What each file prints is printed in the order of files.
+
+    If options has overlap set the files are converted by
+    pipeline.convert_files instead and if it has in_flight set by
+    pipeline.convert_files_concurrently.  If options has manifest set the
+    files that have not changed since they were last converted into the
+    same output directory are skipped, see manifest.ManifestRun, and if it
+    also has incremental set only the time steps added since are converted,
+    see append_file.  If options has cell_major set every input file is
+    written to that one output grouped by cell by transpose.write_cell_major
+    and the output file names are not used.
+
+    Returns:
+        A tuple of (successes, failures) counted from process_file.
+
+    """
+    options = dict(options or {})
+    successes = 0
+    failures = 0
+
+    done = None
+    run = None
+    if options.pop("manifest", False):
+        run = manifest.ManifestRun(files, format_opt, zipped, options)
+        files = run.todo
+        done = run.record
+        print("\nSkipped " + str(run.skipped) + " unchanged files.")
+
+    if "cell_major" in options:
+        box = None
+        if options.get("bbox", "") != "":
+            box = mapping.parse_bbox(options["bbox"])
+
+        return transpose.write_cell_major([input_file
+                                           for input_file, _output in files],
+                                          PARSERS[format_opt],
+                                          zipped,
+                                          options["cell_major"],
+                                          options["transpose_memory"],
+                                          options.get("prefix_cache", ""),
+                                          options.get("fixed_width", False),
+                                          box)
+
+    if "in_flight" in options:
+        return pipeline.convert_files_concurrently(files,
+                                            format_opt,
+                                            zipped,
+                                            options["in_flight"],
+                                            options.get("step_jobs", 1),
+                                            options.get("prefix_cache", ""),
+                                            options.get("fixed_width", False),
+                                            done)
+
+    if options.pop("overlap", False):
+        return pipeline.convert_files(files,
+                                      format_opt,
+                                      zipped,
+                                      options.get("prefix_cache", ""),
+                                      options.get("fixed_width", False),
+                                      done)
+
+    def file_options(index):
+        """ Returns the process_file options for files[index]. """
+        if not options.get("incremental", False):
+            return options
+
+        # The output may be changed in place so its entry is dropped until
+        # it has been converted again.
+        previous = run.previous(index)
+        run.forget(index)
+        return dict(options, previous=previous)
+
+    if jobs == 1 and pool is None:
+        for index, (input_file, output_file) in enumerate(files):
+            result = process_file(input_file, output_file, format_opt, zipped,
+                                  **file_options(index))
+            if result:
+                successes += 1
+                if done is not None:
+                    done(index, result if isinstance(result, dict) else None)
+            else:
+                failures += 1
+
+        return successes, failures
+
+    own_pool = pool is None
+    if own_pool:
+        pool = multiprocessing.Pool(jobs)
+    try:
+        results = [pool.apply_async(process_file_captured,
+                                    ((input_file,
+                                      output_file,
+                                      format_opt,
+                                      zipped,
+                                      file_options(index)),))
+                   for index, (input_file, output_file) in enumerate(files)]
+
+        for index, result in enumerate(results):
+            converted, output = result.get()
+            sys.stdout.write(output)
+            if converted:
+                successes += 1
+                if done is not None:
+                    done(index, converted if isinstance(converted, dict)
+                                else None)
+            else:
+                failures += 1
+
+    finally:
+        if own_pool:
+            pool.close()
+            pool.join()
+
+    return successes, failures
 
 #------------------------------------------------------------------------------
 #     Main
@@ -349,18 +1140,19 @@ def main():
 
     # set some variables for program readability
     num_of_args = len(the_args)
-    num_of_singlefile_args = 4  # this will change with changes to check_args
-    num_of_multifile_args = 6  # ditto for this number
+    num_of_singlefile_args = 5  # this will change with changes to check_args
+    num_of_multifile_args = 10  # ditto for this number
 
     # for single file
     if num_of_args == num_of_singlefile_args:
-        zipped, input_file, output_file, format_opt = the_args
+        zipped, input_file, output_file, format_opt, options = the_args
         print("\nStarting process to reformat GPCP binary data to CSV.")
 
         if not(output_file.endswith(".csv")):
             output_file = output_file + ".csv"
 
-        process_file(input_file, output_file, format_opt, zipped)
+        process_files([(input_file, output_file)], format_opt, zipped,
+                      options=options)
 
         print("\nProcess complete.\n")
 
@@ -371,35 +1163,80 @@ def main():
          output_prefix,
          years,
          months,
-         format_opt) = the_args
+         format_opt,
+         input_dir,
+         catalog_file,
+         jobs,
+         options) = the_args
 
         files_dict = {}
-        for year in years:
-            if format_opt != 2:
+        if input_dir != "":
+            # Every file is opened once and only by process_file, a file
+            # that is not a GPCP file is skipped there.
+            for name in os.listdir(input_dir):
+                if zipped != name.endswith(".gz"):
+                    continue
+
+                in_file = os.path.join(input_dir, name)
                 if zipped:
-                    in_file = input_prefix + year + ".gz"
-                else:
-                    in_file = input_prefix + year
-
-                out_file = output_prefix + year + ".csv"
-                files_dict[in_file] = out_file
-
+                    name = name[:-3]
+                files_dict[in_file] = output_prefix + name + ".csv"
+
+        elif catalog_file != "":
+            # Plan from the catalog, no file is probed on the file system.
+            if format_opt == 3:
+                kinds = ("daily", "monthly")
+            elif format_opt == 2:
+                kinds = ("daily",)
             else:
-                for month in months:
-                    month = month.zfill(2)
+                kinds = ("monthly",)
+
+            the_catalog = catalog.load_catalog(catalog_file)
+            for entry in catalog.find_files(the_catalog, years, months,
+                                            kinds):
+                if entry["zipped"] != zipped:
+                    continue
+                if not entry["complete"]:
+                    print("Skipping truncated file: " + entry["path"])
+                    continue
+
+                out_file = output_prefix + str(entry["year"])
+                if entry["kind"] == "daily":
+                    out_file += str(entry["month"]).zfill(2)
+                files_dict[entry["path"]] = out_file + ".csv"
+
+        else:
+            for year in years:
+                if format_opt != 2:
                     if zipped:
-                        in_file = input_prefix + year + month + ".gz"
+                        in_file = input_prefix + year + ".gz"
                     else:
-                        in_file = input_prefix + year + month
+                        in_file = input_prefix + year
 
-                    out_file = output_prefix + year + month + ".csv"
+                    out_file = output_prefix + year + ".csv"
                     files_dict[in_file] = out_file
 
+                else:
+                    for month in months:
+                        month = month.zfill(2)
+                        if zipped:
+                            in_file = input_prefix + year + month + ".gz"
+                        else:
+                            in_file = input_prefix + year + month
+
+                        out_file = output_prefix + year + month + ".csv"
+                        files_dict[in_file] = out_file
+
         print("\nStarting process to reformat GPCP binary data to CSV.")
 
-        for input_file, output_file in sorted(files_dict.iteritems()):
-            process_file(input_file, output_file, format_opt, zipped)
+        successes, failures = process_files(sorted(files_dict.iteritems()),
+                                            format_opt,
+                                            zipped,
+                                            jobs,
+                                            options)
 
+        print("\nConverted " + str(successes) + " files, " + \
+              str(failures) + " failed.")
         print("\nProcess complete.\n")
 
     # there was an error, the program should never get here
@@ -0,0 +1,292 @@
+#!/usr/local/bin/python2.6
+"""
+Purpose
+-------
+    Keeps a manifest of the conversions done into an output directory so a
+    batch run can skip every file that has not changed since it was last
+    converted, and a run that was stopped part way can pick up where it left
+    off.  Also provides the partial file names used to write outputs so a
+    crash never leaves a half written CSV that looks complete.
+
+Program Flow
+------------
+    Input:
+        The input file, format option and output options of a conversion.
+
+    Output:
+        A JSON file named gpcp_manifest.json in each output directory with
+        an entry per output file holding the input path, size, modification
+        time, format option and the options that change the output.
+
+
+Notes/Lessons Learned
+---------------------
+    An input is taken as unchanged when its size and modification time are
+    the same as when it was converted, the way make does it, so no input is
+    read just to decide if it needs converting.  The manifest is saved after
+    every file so it is always up to date.
+
+--------
+
+"""
+#------------------------------------------------------------------------------
+#     Imports
+#------------------------------------------------------------------------------
+
+
+# The __future__ print function is used to ensure an easier path to
+# Python 3 if and when the upgrade is needed.
+from __future__ import print_function
+
+# built-ins
+import hashlib
+import json
+import os
+import tempfile
+
+# The manifest kept in each output directory.
+MANIFEST_NAME = "gpcp_manifest.json"
+
+# Outputs are written under their name plus this and renamed when complete.
+PART_SUFFIX = ".part"
+
+# The process_file options that change the output, others only change how
+# fast it is written.
+OUTPUT_OPTIONS = ("fixed_width", "bbox", "star_columns")
+
+#------------------------------------------------------------------------------
+#     Functions
+#------------------------------------------------------------------------------
+
+
+def part_name(output_filename):
+    """ Returns the name an output is written under until it is complete. """
+    return output_filename + PART_SUFFIX
+
+
+def commit_output(output_filename):
+    """ Renames the complete partial output to its real name. """
+    if os.name == "nt" and os.path.exists(output_filename):
+        # Windows will not rename over an existing file.
+        os.remove(output_filename)
+
+    os.rename(part_name(output_filename), output_filename)
+
+
+def write_atomic(filename, write, mode='wb'):
+    """ Calls write(handle) with a temporary file, opened with mode, in the
+    directory of filename and renames it to filename once written, so no
+    other process ever reads half a file.  The temporary file ends in
+    PART_SUFFIX like the outputs and is removed if write fails.
+
+    """
+    handle, temp_name = tempfile.mkstemp(suffix=PART_SUFFIX,
+                                         dir=os.path.dirname(filename) or ".")
+    try:
+        with os.fdopen(handle, mode) as temp_file:
+            write(temp_file)
+
+        # mkstemp makes the file readable by its owner only.
+        os.chmod(temp_name, 0644)
+        if os.name == "nt" and os.path.exists(filename):
+            # Windows will not rename over an existing file.
+            os.remove(filename)
+        os.rename(temp_name, filename)
+
+    except:
+        if os.path.exists(temp_name):
+            os.remove(temp_name)
+        raise
+
+
+def input_key(input_filename, format_opt, zipped, options):
+    """ Returns what the manifest records of a conversion, or None if the
+    input file can not be found.
+
+    """
+    try:
+        stat = os.stat(input_filename)
+    except OSError:
+        return None
+
+    output_options = {}
+    for name in OUTPUT_OPTIONS:
+        if name in options:
+            output_options[name] = options[name]
+
+    return {"input": os.path.abspath(input_filename),
+            "size": stat.st_size,
+            "mtime": stat.st_mtime,
+            "format": format_opt,
+            "zipped": zipped,
+            "options": output_options}
+
+
+def header_fingerprint(header):
+    """ Returns a checksum of a file header without the parts that change
+    as more time steps are published, the months=/days= range and the
+    creation date.
+
+    """
+    items = [item for item in header.split(" ")
+             if not item.startswith(("months=", "days=", "creation_date="))]
+
+    return hashlib.md5(" ".join(items)).hexdigest()
+
+
+def resume_point(previous, key, output_filename, fingerprint, declared):
+    """ Returns the (time step, output size) an incremental conversion can
+    carry on from, or (0, 0) if the output has to be written from scratch.
+    It can carry on if the output was last written by an incremental
+    conversion of the same input with the same options, has not been
+    touched since, and the header only differs in its creation date and its
+    declared (first, last) range, which has to start at the same time step
+    and not end any sooner.
+
+    """
+    if previous is None or "steps" not in previous or key is None:
+        return 0, 0
+
+    for name in ("input", "format", "zipped", "options"):
+        if previous[name] != key[name]:
+            return 0, 0
+
+    if previous["fingerprint"] != fingerprint or \
+       previous["range_start"] != declared[0] or \
+       previous["steps"] > declared[1]:
+        return 0, 0
+
+    try:
+        if os.path.getsize(output_filename) != previous["output_size"]:
+            return 0, 0
+    except OSError:
+        return 0, 0
+
+    return previous["steps"], previous["settled_size"]
+
+#------------------------------------------------------------------------------
+#     Class:  Manifest
+#------------------------------------------------------------------------------
+
+
+class Manifest(object):
+    """ The manifest of the conversions done into one output directory. """
+    def __init__(self, directory):
+        """ The initialization function for an object, reads the manifest of
+        directory if there is one.
+
+        """
+        self.directory = directory
+        self.filename = os.path.join(directory, MANIFEST_NAME)
+        self.entries = {}
+
+        try:
+            with open(self.filename, 'r') as handle:
+                self.entries = json.load(handle)
+        except (IOError, ValueError):
+            # No manifest yet, or a damaged one, converts everything again.
+            pass
+
+    def is_current(self, output_filename, key):
+        """ Returns True if output_filename exists and was converted from an
+        input with the same key.
+
+        """
+        entry = self.get(output_filename)
+        if key is None or entry is None or not os.path.exists(output_filename):
+            return False
+
+        # An incremental conversion adds what it needs to carry on from.
+        for name, value in key.iteritems():
+            if entry.get(name) != value:
+                return False
+
+        return True
+
+    def get(self, output_filename):
+        """ Returns the entry of output_filename, None if there is none. """
+        return self.entries.get(os.path.basename(output_filename))
+
+    def record(self, output_filename, key):
+        """ Records output_filename was converted with key and saves. """
+        if key is None:
+            return
+
+        self.entries[os.path.basename(output_filename)] = key
+        self.save()
+
+    def forget(self, output_filename):
+        """ Drops the entry of output_filename and saves, done before an
+        output is changed in place so a crash can not leave an entry that
+        looks up to date.
+
+        """
+        if self.entries.pop(os.path.basename(output_filename), None) \
+           is not None:
+            self.save()
+
+    def save(self):
+        """ Writes the manifest with write_atomic. """
+        write_atomic(self.filename,
+                     lambda handle: json.dump(self.entries, handle, indent=1,
+                                              sort_keys=True),
+                     'w')
+
+#------------------------------------------------------------------------------
+#     Class:  ManifestRun
+#------------------------------------------------------------------------------
+
+
+class ManifestRun(object):
+    """ Checks every (input file, output file) pair of a batch against the
+    manifest of its output directory and records each one converted.
+
+    """
+    def __init__(self, files, format_opt, zipped, options):
+        """ The initialization function for an object.  Pairs that have not
+        changed since they were last converted are printed and skipped, the
+        rest are in self.todo.
+
+        """
+        manifests = {}
+        self.todo = []
+        self.skipped = 0
+        self._keys = []
+        for input_file, output_file in files:
+            directory = os.path.dirname(os.path.abspath(output_file))
+            if directory not in manifests:
+                manifests[directory] = Manifest(directory)
+
+            key = input_key(input_file, format_opt, zipped, options)
+            if manifests[directory].is_current(output_file, key):
+                print("Skipping unchanged file: " + input_file)
+                self.skipped += 1
+                continue
+
+            self.todo.append((input_file, output_file))
+            self._keys.append((manifests[directory], key))
+
+    def previous(self, index):
+        """ Returns the manifest entry of the output of todo[index] from the
+        last time it was converted, None if there is none.
+
+        """
+        the_manifest, _key = self._keys[index]
+        return the_manifest.get(self.todo[index][1])
+
+    def forget(self, index):
+        """ Drops the manifest entry of the output of todo[index]. """
+        the_manifest, _key = self._keys[index]
+        the_manifest.forget(self.todo[index][1])
+
+    def record(self, index, progress=None):
+        """ Records todo[index] as converted.  progress is what an
+        incremental conversion needs to carry on from next time, see
+        gpcp_to_csv.append_file.
+
+        """
+        the_manifest, key = self._keys[index]
+        if key is not None and progress:
+            key = dict(key, **progress)
+
+        the_manifest.record(self.todo[index][1], key)
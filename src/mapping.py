@@ -22,7 +22,276 @@ Notes/Lessons Learned
 #------------------------------------------------------------------------------
 
 
-# No imports are needed for this set of classes.
+# built-ins
+import array
+import hashlib
+import math
+import os
+
+# external
+import manifest
+
+# The coordinate tables and prefixes already computed, keyed by the grid
+# specification.
+_COORDINATE_TABLES = {}
+_COORDINATE_PREFIXES = {}
+
+#------------------------------------------------------------------------------
+#     Functions
+#------------------------------------------------------------------------------
+
+
+def step_axis(start, delta, count):
+    """ Returns an array of count floats from start stepped by delta.  The
+    values are added up one step at a time, the way the map always has been,
+    so they are exactly the same.
+
+    """
+    axis = array.array('d')
+    point = start
+    for _counter in xrange(count):
+        axis.append(point)
+        point += delta
+
+    return axis
+
+
+def coordinate_table(start, delta, points_per_row, rows):
+    """ Returns the signed decimal (latitude, longitude) of every cell of a
+    grid, a row at a time from start, a (latitude, longitude) tuple of the
+    first box center.  Latitudes step south and longitudes east by delta,
+    both are rounded to two places and longitudes of 180 or more are
+    wrapped to negative (west) values.
+
+    The table is computed once per grid for the life of the process and is
+    shared, it is a tuple of tuples so it can not be changed by mistake.
+
+    """
+    key = (start, delta, points_per_row, rows)
+    if key not in _COORDINATE_TABLES:
+        # A latitude of 0 has always been written as -0.0 (south).
+        lats = [round(lat, 2) if lat > 0 else -round(abs(lat), 2)
+                for lat in step_axis(start[0], -1 * delta, rows)]
+
+        # This is where some math using 1st_box_center should be done to
+        # determine the correct value to add/subtract.  For the current
+        # files being used it is 360, but this might not always be the case.
+        lons = [round(lon, 2) if lon < 180 else round(lon, 2) - 360
+                for lon in step_axis(start[1], delta, points_per_row)]
+
+        _COORDINATE_TABLES[key] = tuple([(lat, lon)
+                                         for lat in lats for lon in lons])
+
+    return _COORDINATE_TABLES[key]
+
+
+def coordinate_prefixes(start, delta, points_per_row, rows, cache_dir=None,
+                        prefix_format=None):
+    """ Returns the "latitude,longitude," text that starts the CSV line of
+    every cell of a grid, in the order of coordinate_table.  The text is
+    rendered once per grid for the life of the process.  The latitude and
+    longitude are written with str() unless a prefix_format such as
+    "%07.2f,%07.2f," is given.
+
+    If cache_dir is given the prefixes are also kept in a file there named
+    for the grid, so later processes read them instead of rendering them.
+
+    """
+    key = (start, delta, points_per_row, rows, prefix_format)
+    if key in _COORDINATE_PREFIXES:
+        return _COORDINATE_PREFIXES[key]
+
+    prefixes = None
+    if cache_dir:
+        cache_name = "gpcp_prefixes_%r_%r_%r_%dx%d" % \
+                     (start[0], start[1], delta, points_per_row, rows)
+        if prefix_format is not None:
+            cache_name += "_" + hashlib.md5(prefix_format).hexdigest()[:8]
+        cache_file = os.path.join(cache_dir, cache_name + ".txt")
+        try:
+            with open(cache_file, 'r') as handle:
+                prefixes = tuple(handle.read().split("\n"))
+        except IOError:
+            pass
+
+        # A damaged cache file is rendered again.
+        if prefixes is not None and len(prefixes) != points_per_row * rows:
+            prefixes = None
+
+    if prefixes is None:
+        table = coordinate_table(start, delta, points_per_row, rows)
+        if prefix_format is None:
+            prefixes = tuple([str(lat) + "," + str(lon) + ","
+                              for lat, lon in table])
+        else:
+            prefixes = tuple([prefix_format % (lat, lon)
+                              for lat, lon in table])
+
+        if cache_dir:
+            # A cache that can not be written is only a slower run, the
+            # table in memory is used.
+            try:
+                manifest.write_atomic(cache_file,
+                                      lambda handle: handle.write(
+                                          "\n".join(prefixes)))
+            except (OSError, IOError):
+                pass
+
+    _COORDINATE_PREFIXES[key] = prefixes
+    return prefixes
+
+
+def parse_bbox(text):
+    """ Returns the (south, west, north, east) of a box given as the text
+    "S,W,N,E" in signed decimal degrees.  Longitudes east of 180 are
+    wrapped to negative (west) values as in coordinate_table, a box with
+    west greater than east crosses the 180 degree meridian.
+
+    Raises:
+        ValueError if the text is not a box.
+
+    """
+    try:
+        south, west, north, east = [float(part) for part in text.split(",")]
+    except ValueError:
+        raise ValueError("A box must be given as S,W,N,E, i.e. " + \
+                         "-35,-20,38,52.")
+
+    if south > north:
+        raise ValueError("The south of a box must not be north of its " + \
+                         "north.")
+
+    if east - west >= 360:
+        # All the way around.
+        west, east = -180.0, 180.0
+    if west > 180:
+        west -= 360
+    if east > 180:
+        east -= 360
+
+    return south, west, north, east
+
+
+def box_slices(start, delta, points_per_row, rows, box):
+    """ Returns the cells of a grid, as for coordinate_table, whose centers
+    are in box, a (south, west, north, east) from parse_bbox.
+
+    Returns:
+        A tuple of (first_row, last_row, runs) where runs is a tuple of the
+        (first_col, last_col) of each run of columns in the box, in file
+        order.  A box that crosses the 0 or 180 degree meridian in the file
+        has two runs.
+
+    Raises:
+        ValueError if no cell of the grid is in the box.
+
+    """
+    south, west, north, east = box
+    table = coordinate_table(start, delta, points_per_row, rows)
+
+    box_rows = [row for row in xrange(rows)
+                if south <= table[row * points_per_row][0] <= north]
+
+    if west <= east:
+        cols = [col for col in xrange(points_per_row)
+                if west <= table[col][1] <= east]
+    else:
+        cols = [col for col in xrange(points_per_row)
+                if table[col][1] >= west or table[col][1] <= east]
+
+    if not box_rows or not cols:
+        raise ValueError("No cell of the grid is in the box.")
+
+    runs = []
+    for col in cols:
+        if runs and runs[-1][1] == col - 1:
+            runs[-1] = (runs[-1][0], col)
+        else:
+            runs.append((col, col))
+
+    return box_rows[0], box_rows[-1], tuple(runs)
+
+
+def box_cells(slices, points_per_row):
+    """ Returns the index in file order of every cell of the slices from
+    box_slices.
+
+    """
+    first_row, last_row, runs = slices
+    return [row * points_per_row + col
+            for row in xrange(first_row, last_row + 1)
+            for first_col, last_col in runs
+            for col in xrange(first_col, last_col + 1)]
+
+
+def point_cells(start, delta, points_per_row, rows, lat, lon,
+                method="nearest"):
+    """ Returns the cells of a grid, as for coordinate_table, that give the
+    value at the point lat, lon in signed decimal degrees.  The row and
+    column are worked out from the first box center and the spacing, no
+    table is searched.  Longitudes wrap around a grid that goes all the way
+    around, points past the edges of the grid take the edge cells.
+
+    Returns:
+        A tuple of the (index in file order, weight) of each cell, the one
+        nearest cell for the "nearest" method or up to the four around the
+        point for "bilinear".  The weights add up to 1.
+
+    Raises:
+        ValueError if the method is not "nearest" or "bilinear".
+
+    """
+    row = (start[0] - lat) / delta
+    wraps = abs(points_per_row * delta - 360) < delta / 2
+    if wraps:
+        col = ((lon - start[1]) % 360) / delta
+    else:
+        col = (lon - start[1]) / delta
+
+    if method == "nearest":
+        row = min(max(int(round(row)), 0), rows - 1)
+        col = int(round(col))
+        if wraps:
+            col %= points_per_row
+        else:
+            col = min(max(col, 0), points_per_row - 1)
+
+        return ((row * points_per_row + col, 1.0),)
+
+    if method != "bilinear":
+        raise ValueError("The method must be nearest or bilinear.")
+
+    rows_around = _neighbours(row, rows, False)
+    cols_around = _neighbours(col, points_per_row, wraps)
+
+    weights = {}
+    for row, row_weight in rows_around:
+        for col, col_weight in cols_around:
+            cell = row * points_per_row + col
+            weights[cell] = weights.get(cell, 0.0) + row_weight * col_weight
+
+    return tuple(sorted([(cell, weight)
+                         for cell, weight in weights.iteritems()
+                         if weight > 0]))
+
+
+def _neighbours(position, count, wraps):
+    """ Returns the (index, weight) of the two indexes either side of a
+    fractional position along an axis of count cells for point_cells.
+
+    """
+    first = int(math.floor(position))
+    fraction = position - first
+    if wraps:
+        return ((first % count, 1 - fraction),
+                ((first + 1) % count, fraction))
+
+    if first < 0:
+        return ((0, 1.0),)
+    if first >= count - 1:
+        return ((count - 1, 1.0),)
+
+    return ((first, 1 - fraction), (first + 1, fraction))
 
 #------------------------------------------------------------------------------
 #     Class:  Coord and derived classes Lat, Lon and LatLon
@@ -147,7 +416,11 @@ class LatLon(object):
 
 
 class GeoMap(object):
-    """ Defines a map area and associated string for printing. """
+    """ Defines a map area and associated string for printing.  The latitude
+    and longitude axes are held as compact arrays of floats, LatLon objects
+    for the cells are only created when asked for.
+
+    """
     def __init__(self,
                  topleft,
                  next_point,
@@ -158,27 +431,54 @@ class GeoMap(object):
         points_per_row and rows are provided for the original format.
 
         """
-        self.map = []
         self.topleft = topleft
-        map_lat = topleft.lat.point
-        _start_lat = topleft.lat.point
-        start_lon = topleft.lon.point
-
-        delta = max(topleft.delta_to(next_point))
+        self.delta = max(topleft.delta_to(next_point))
+        self._map = None
 
-        for _i_counter in range(rows):
-            row = []
-            map_lon = start_lon
-            for _j_counter in range(points_per_row):
-                row.append(LatLon(Lat(map_lat), Lon(map_lon)))
-                map_lon += delta
-            self.map.append(row)
-            map_lat += -1 * delta
+        self.lats = step_axis(topleft.lat.point, -1 * self.delta, rows)
+        self.lons = step_axis(topleft.lon.point, self.delta, points_per_row)
 
     def __str__(self):
         """ For printing the instance of the object. """
         return "\n".join([", ".join([str(ll) for ll in row]) \
-                          for row in self.map])
+                          for row in self.iter_rows()])
+
+    @property
+    def map(self):
+        """ The whole map as a list of rows of LatLon objects.  It is only
+        created the first time it is used, iter_rows is cheaper.
+
+        """
+        if self._map is None:
+            self._map = list(self.iter_rows())
+
+        return self._map
+
+    def iter_rows(self):
+        """ Yields each row of the map as a list of LatLon objects. """
+        for row in xrange(len(self.lats)):
+            yield [self.get_cell(row, col) for col in xrange(len(self.lons))]
+
+    def get_cell(self, row, col):
+        """ Returns the LatLon of the cell at row, col. """
+        return LatLon(Lat(self.lats[row]), Lon(self.lons[col]))
+
+    def point_cells(self, lat, lon, method="nearest"):
+        """ Returns the (index, weight) of the cells of the map that give the
+        value at lat, lon, see the point_cells function.
+
+        """
+        return point_cells((self.lats[0], self.lons[0]),
+                           self.delta,
+                           len(self.lons),
+                           len(self.lats),
+                           lat,
+                           lon,
+                           method)
+
+    def get_shape(self):
+        """ Returns the number of (rows, points_per_row) of the map. """
+        return (len(self.lats), len(self.lons))
 
     def get_start_lat(self):
         """ Returns the starting latitude coordinate. """
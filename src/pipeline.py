@@ -0,0 +1,472 @@
+#!/usr/local/bin/python2.6
+"""
+Purpose
+-------
+    Converts a batch of GPCP files with the reading, decoding, formatting and
+    writing overlapped.  Each stage runs in its own thread and hands its work
+    to the next through a small bounded queue, so the disk is kept busy while
+    Python formats and the next file is read (and decompressed) while the
+    current one is still being written.
+
+    For batches on slow (network) disks convert_files_concurrently instead
+    keeps several files in flight at once, each in its own thread, with the
+    formatting optionally done by a shared pool of processes.
+
+    Also holds the jobs run by the worker processes of the pools used by
+    gpcp_to_csv to format the time steps of a file in parallel.
+
+Program Flow
+------------
+    Input:
+        A list of (input file, output file) pairs, the format option and if
+        the input files are zipped, as for gpcp_to_csv.process_file.
+
+    Output:
+        The same CSV files process_file writes for the one-line formats.
+
+    The stages are:
+        reader     opens each file in turn, reads the header and the raw
+                   time steps.  It moves on to the next file as soon as it
+                   is done with one.
+        decoder    decodes each raw time step into floats.
+        formatter  formats each time step into CSV text.
+        writer     writes the text to the output files, this is run by the
+                   calling thread.
+
+
+Notes/Lessons Learned
+---------------------
+    Threads only overlap work that releases the interpreter lock, which
+    file reads and writes and zlib decompression do.  The formatting itself
+    still runs one step at a time unless a pool of processes is used.  The
+    queues are bounded so memory use is bounded by a few time steps per stage
+    (and per file in flight) no matter how far ahead the reading could get.
+
+    Python 2 has no asyncio, so the files in flight are plain threads limited
+    by a semaphore rather than coroutines.
+
+--------
+
+"""
+#------------------------------------------------------------------------------
+#     Imports
+#------------------------------------------------------------------------------
+
+
+# The __future__ print function is used to ensure an easier path to
+# Python 3 if and when the upgrade is needed.
+from __future__ import print_function
+
+# built-ins
+import collections
+import gzip
+import multiprocessing
+import os
+import Queue
+import threading
+import traceback
+
+# external
+import gpcp_parsers
+import manifest
+
+# How many time steps can wait between two stages, or be formatting at once
+# for a file converted by convert_files_concurrently.
+QUEUE_SIZE = 4
+
+# Put on a queue after the last item.
+STOP = None
+
+# The parsers made from a file header by step_parser, kept per process.
+_STEP_PARSERS = {}
+
+#------------------------------------------------------------------------------
+#     Functions
+#------------------------------------------------------------------------------
+
+
+def read_files(files, parser_class, zipped, prefix_cache, fixed_width,
+               out_queue):
+    """ The reader stage.  For each (input file, output file) in files puts
+    ("open", index, (output file, parser)), then ("step", index, (step,
+    packed)) for each time step and ("close", index, None) on out_queue.  A
+    file that can not be read is put as ("fail", index, message).
+
+    """
+    for index, (input_file, output_file) in enumerate(files):
+        try:
+            if zipped:
+                handle = gzip.open(input_file, 'rb')
+            else:
+                handle = open(input_file, 'rb')
+
+        except IOError, error:
+            out_queue.put(("fail", index, "IOError: " + str(error)))
+            continue
+
+        try:
+            try:
+                header = gpcp_parsers.read_header(handle)
+                parser = gpcp_parsers.header_parser(header, parser_class)
+                if prefix_cache != "":
+                    parser.prefix_cache_dir = prefix_cache
+                parser.fixed_width = fixed_width
+                out_queue.put(("open", index, (output_file, parser)))
+
+                step_size = parser.rows_per_step() * \
+                            int(parser.variables["points_per_row"]) * 4
+                step = 0
+                while True:
+                    packed = handle.read(step_size)
+                    if len(packed) < step_size:
+                        break
+
+                    out_queue.put(("step", index, (step, packed)))
+                    step += 1
+
+                out_queue.put(("close", index, None))
+
+            except Exception:
+                out_queue.put(("fail", index, traceback.format_exc()))
+
+        finally:
+            handle.close()
+
+    out_queue.put(STOP)
+
+
+def decode_steps(in_queue, out_queue):
+    """ The decoder stage, decodes the packed data of each time step. """
+    for kind, index, payload in iter(in_queue.get, STOP):
+        if kind == "step":
+            step, packed = payload
+            payload = (step, gpcp_parsers.decode(packed))
+
+        out_queue.put((kind, index, payload))
+
+    out_queue.put(STOP)
+
+
+def format_steps(in_queue, out_queue):
+    """ The formatter stage, formats each time step into CSV text with the
+    parser of its file.  A file that fails is put as a "fail" item and the
+    rest of its time steps are dropped.
+
+    """
+    parsers = {}
+    for kind, index, payload in iter(in_queue.get, STOP):
+        if kind == "open":
+            output_file, parsers[index] = payload
+            payload = output_file
+
+        elif kind == "step":
+            if index not in parsers:
+                continue
+
+            try:
+                payload = "".join(parsers[index].format_steps([payload]))
+            except Exception:
+                kind = "fail"
+                payload = traceback.format_exc()
+                del parsers[index]
+
+        elif kind == "close":
+            if index not in parsers:
+                continue
+            del parsers[index]
+
+        elif kind == "fail":
+            parsers.pop(index, None)
+
+        out_queue.put((kind, index, payload))
+
+    out_queue.put(STOP)
+
+
+def step_parser(parser_class, header, prefix_cache, fixed_width=False,
+                box=None, columns=None):
+    """ Returns the parser for a header for a worker process of a pool.  It
+    is made once per worker process and kept.
+
+    """
+    key = (parser_class, header, fixed_width, box, columns)
+    if key not in _STEP_PARSERS:
+        parser = gpcp_parsers.header_parser(header, parser_class, box)
+        if prefix_cache != "":
+            parser.prefix_cache_dir = prefix_cache
+        parser.fixed_width = fixed_width
+        parser.columns = columns
+        _STEP_PARSERS[key] = parser
+
+    return _STEP_PARSERS[key]
+
+
+def format_step_job(job):
+    """ Formats one time step of a file for a worker process of a pool.
+
+    Input:
+        A tuple of (parser_class, header, prefix_cache, fixed_width, box,
+        columns, step, values).
+
+    Returns:
+        The CSV text of the time step.
+
+    """
+    parser_class, header, prefix_cache, fixed_width, box, columns, step, \
+        values = job
+    parser = step_parser(parser_class, header, prefix_cache, fixed_width, box,
+                         columns)
+
+    return "".join(parser.format_steps([(step, values)]))
+
+
+def write_step_job(job):
+    """ Formats one time step of a file as fixed-width records and writes it
+    straight into its place in the output file, for a worker process of a
+    pool.
+
+    Input:
+        A tuple of (parser_class, header, prefix_cache, box,
+        output_filename, step, values).
+
+    Returns:
+        The time step written.
+
+    """
+    parser_class, header, prefix_cache, box, output_filename, step, \
+        values = job
+    parser = step_parser(parser_class, header, prefix_cache, True, box)
+
+    text = "".join(parser.format_steps([(step, values)]))
+    with open(output_filename, 'r+b') as out_file:
+        out_file.seek(parser.step_offset(step))
+        out_file.write(text)
+
+    return step
+
+
+def start_stage(target, *args):
+    """ Runs target(*args) in a daemon thread and returns the thread. """
+    thread = threading.Thread(target=target, args=args)
+    thread.setDaemon(True)
+    thread.start()
+    return thread
+
+
+def convert_files(files, format_opt, zipped, prefix_cache="",
+                  fixed_width=False, done=None):
+    """ Converts every (input file, output file) pair in files with the
+    stages overlapped.  Only the one-line formats 1, 2 and 3 (detected) are
+    supported, fixed_width is as for GpcpParser.  If done is given it is
+    called with the index in files of each file converted.
+
+    Returns:
+        A tuple of (successes, failures).
+
+    """
+    parser_class = {1: gpcp_parsers.GpcpParserOriginalOneLine,
+                    2: gpcp_parsers.GpcpParserNewOneLine,
+                    3: None}[format_opt]
+
+    raw_queue = Queue.Queue(QUEUE_SIZE)
+    decoded_queue = Queue.Queue(QUEUE_SIZE)
+    text_queue = Queue.Queue(QUEUE_SIZE)
+
+    threads = [start_stage(read_files, files, parser_class, zipped,
+                           prefix_cache, fixed_width, raw_queue),
+               start_stage(decode_steps, raw_queue, decoded_queue),
+               start_stage(format_steps, decoded_queue, text_queue)]
+
+    # The writer stage
+    successes = 0
+    failures = 0
+    outputs = {}
+    failed = set()
+    for kind, index, payload in iter(text_queue.get, STOP):
+        if index in failed:
+            continue
+
+        if kind == "open":
+            try:
+                outputs[index] = (payload,
+                                  open(manifest.part_name(payload),
+                                       'wb' if fixed_width else 'w'))
+                print("Writing CSV value to ", payload)
+            except IOError, error:
+                kind = "fail"
+                payload = "IOError: " + str(error)
+
+        elif kind == "step":
+            try:
+                outputs[index][1].write(payload)
+            except IOError, error:
+                kind = "fail"
+                payload = "IOError: " + str(error)
+
+        elif kind == "close":
+            output_file, handle = outputs[index]
+            try:
+                handle.close()
+                manifest.commit_output(output_file)
+            except (IOError, OSError), error:
+                kind = "fail"
+                payload = error.__class__.__name__ + ": " + str(error)
+            else:
+                del outputs[index]
+                successes += 1
+                if done is not None:
+                    done(index)
+
+        if kind == "fail":
+            if index in outputs:
+                # Never leave half a file that looks complete.
+                output_file, handle = outputs.pop(index)
+                handle.close()
+                if os.path.exists(manifest.part_name(output_file)):
+                    os.remove(manifest.part_name(output_file))
+
+            print("\n" + payload)
+            print("Skipping file: " + files[index][0] + "\n")
+            failed.add(index)
+            failures += 1
+
+    for thread in threads:
+        thread.join()
+
+    return successes, failures
+
+
+def convert_one(index, files, parser_class, zipped, prefix_cache, fixed_width,
+                pool, report):
+    """ Converts files[index] for convert_files_concurrently, reading,
+    decoding and writing in this thread and formatting in the pool if one
+    is given.  At most QUEUE_SIZE time steps of the file are formatting at
+    once, so a slow writer holds back the reading.  The result is passed to
+    report(index, converted, message).
+
+    """
+    input_file, output_file = files[index]
+    out_file = None
+    try:
+        if zipped:
+            handle = gzip.open(input_file, 'rb')
+        else:
+            handle = open(input_file, 'rb')
+
+        try:
+            header = gpcp_parsers.read_header(handle)
+            parser = step_parser(parser_class or
+                                 gpcp_parsers.detect_parser(header),
+                                 header, prefix_cache, fixed_width)
+            step_size = parser.rows_per_step() * \
+                        int(parser.variables["points_per_row"]) * 4
+
+            out_file = open(manifest.part_name(output_file),
+                            'wb' if fixed_width else 'w')
+            pending = collections.deque()
+            step = 0
+            while True:
+                packed = handle.read(step_size)
+                if len(packed) < step_size:
+                    break
+
+                values = gpcp_parsers.decode(packed)
+                if pool is None:
+                    out_file.write("".join(parser.format_steps([(step,
+                                                                 values)])))
+                else:
+                    pending.append(pool.apply_async(format_step_job,
+                                   ((parser.__class__, header, prefix_cache,
+                                     fixed_width, None, None, step,
+                                     values),)))
+                    if len(pending) >= QUEUE_SIZE:
+                        out_file.write(pending.popleft().get())
+                step += 1
+
+            while pending:
+                out_file.write(pending.popleft().get())
+
+            out_file.close()
+            manifest.commit_output(output_file)
+
+        finally:
+            handle.close()
+
+    except Exception, error:
+        if out_file is not None:
+            # Never leave half a file that looks complete.
+            out_file.close()
+            if os.path.exists(manifest.part_name(output_file)):
+                os.remove(manifest.part_name(output_file))
+
+        if isinstance(error, IOError):
+            report(index, False, "IOError: " + str(error))
+        else:
+            report(index, False, traceback.format_exc())
+
+    else:
+        report(index, True, "Writing CSV value to  " + output_file)
+
+
+def convert_files_concurrently(files, format_opt, zipped, in_flight,
+                               step_jobs=1, prefix_cache="",
+                               fixed_width=False, done=None):
+    """ Converts every (input file, output file) pair in files with up to
+    in_flight files being opened, read and written at the same time, for
+    batches dominated by waiting on slow (network) disks.  If step_jobs is
+    more than 1 the formatting is done by a pool of that many processes
+    shared by all the files.  Only the one-line formats 1, 2 and 3
+    (detected) are supported, fixed_width is as for GpcpParser and done as
+    for convert_files.
+
+    Returns:
+        A tuple of (successes, failures).
+
+    """
+    parser_class = {1: gpcp_parsers.GpcpParserOriginalOneLine,
+                    2: gpcp_parsers.GpcpParserNewOneLine,
+                    3: None}[format_opt]
+
+    pool = None
+    if step_jobs > 1:
+        pool = multiprocessing.Pool(step_jobs)
+
+    # A file is only started once there is room for it.
+    slots = threading.Semaphore(in_flight)
+    lock = threading.Lock()
+    counts = [0, 0]
+
+    def report(index, converted, message):
+        """ Prints the result of a file and frees its slot. """
+        lock.acquire()
+        try:
+            if converted:
+                counts[0] += 1
+                print(message)
+                if done is not None:
+                    done(index)
+            else:
+                counts[1] += 1
+                print("\n" + message)
+                print("Skipping file: " + files[index][0] + "\n")
+        finally:
+            lock.release()
+            slots.release()
+
+    threads = []
+    try:
+        for index in xrange(len(files)):
+            slots.acquire()
+            threads.append(start_stage(convert_one, index, files,
+                                       parser_class, zipped, prefix_cache,
+                                       fixed_width, pool, report))
+
+        for thread in threads:
+            thread.join()
+
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    return counts[0], counts[1]
@@ -0,0 +1,312 @@
+#!/usr/local/bin/python2.6
+"""
+Purpose
+-------
+    Extracts the GPCP time series of a list of stations, such as rain
+    gauges, from the archive without converting the files.  Each station is
+    placed on the grid of each file by arithmetic and only the 4 byte values
+    of its cells are read, so the cost is in proportion to the number of
+    stations times the number of time steps and not to the size of the
+    files.
+
+Program Flow
+------------
+    Input:
+        A CSV file of stations, one per line as station_id,latitude,longitude
+        in signed decimal degrees with an optional header line, the first
+        and last date and where the files are, by the input prefix naming
+        scheme of gpcp_to_csv or a catalog from catalog.py, i.e.
+        python points.py -t stations.csv -s 19961001 -e 20111231 -f 2 -z
+                         -p ./gpcp_1dd_v1.2_p1d. -o stations_daily.csv
+
+    Output:
+        One CSV file with a line per station per time step:
+        station_id,YYYYMMDD,value
+        in date order, the stations in the order of the station file.
+
+
+Notes/Lessons Learned
+---------------------
+    With the nearest method a station takes the value of the cell its
+    point is in.  With the bilinear method it is weighted from the up to
+    four cell centers around it, and is the missing value if any of those is
+    missing.
+
+    The cells of all the stations are read together in file order for each
+    time step, stations that share a cell read it once and cells next to each
+    other are read as one.  A gzip file is still decompressed up to the last
+    time step needed, as in query.py.
+
+--------
+
+"""
+#------------------------------------------------------------------------------
+#     Imports
+#------------------------------------------------------------------------------
+
+
+# The __future__ print function is used to ensure an easier path to
+# Python 3 if and when the upgrade is needed.
+from __future__ import print_function
+
+# built-ins
+import argparse
+import csv
+import gzip
+
+# external
+import catalog
+import cube
+import gpcp_parsers
+import mapping
+import query
+
+# The ways a station can take its value from the grid.
+METHODS = ("nearest", "bilinear")
+
+#------------------------------------------------------------------------------
+#     Functions
+#------------------------------------------------------------------------------
+
+
+def load_stations(filename):
+    """ Returns the (station_id, latitude, longitude) of each station in a
+    CSV file of station_id,latitude,longitude lines.  A first line that
+    does not hold a latitude and longitude is taken as a header.
+
+    Raises:
+        IOError if the file can not be read.
+        ValueError if a line is not a station.
+
+    """
+    stations = []
+    with open(filename, 'rb') as handle:
+        for line_number, row in enumerate(csv.reader(handle)):
+            if not row:
+                continue
+
+            try:
+                station_id, lat, lon = row
+                stations.append((station_id.strip(), float(lat), float(lon)))
+            except ValueError:
+                if line_number == 0:
+                    continue
+                raise ValueError("Line " + str(line_number + 1) + " of " + \
+                                 filename + " is not station_id," + \
+                                 "latitude,longitude.")
+
+    return stations
+
+#------------------------------------------------------------------------------
+#     Class:  StationSet
+#------------------------------------------------------------------------------
+
+
+class StationSet(object):
+    """ A list of stations and what to read for them from a time step of
+    each grid.
+
+    """
+    def __init__(self, stations, method="nearest"):
+        """ The initialization function for an object.  stations are as from
+        load_stations.
+
+        """
+        if method not in METHODS:
+            raise ValueError("The method must be nearest or bilinear.")
+
+        self.stations = stations
+        self.method = method
+        self._grids = {}
+
+    def resolve(self, grid_spec):
+        """ Returns the byte ranges to read from each time step of a grid,
+        from gpcp_parsers.cell_ranges, and for each station the (position in
+        the values read, weight) of its cells.  Worked out once per grid.
+
+        """
+        if grid_spec not in self._grids:
+            station_cells = [mapping.point_cells(*(grid_spec +
+                                                   (lat, lon, self.method)))
+                             for _station_id, lat, lon in self.stations]
+
+            cells = sorted(set([cell for pairs in station_cells
+                                for cell, _weight in pairs]))
+            positions = dict([(cell, position)
+                              for position, cell in enumerate(cells)])
+
+            self._grids[grid_spec] = (gpcp_parsers.cell_ranges(cells),
+                                      [tuple([(positions[cell], weight)
+                                              for cell, weight in pairs])
+                                       for pairs in station_cells])
+
+        return self._grids[grid_spec]
+
+    def format_step(self, date, values, weights, missing_value):
+        """ Returns the CSV text of every station for one time step from the
+        values read for it.
+
+        """
+        lines = []
+        for (station_id, _lat, _lon), pairs in zip(self.stations, weights):
+            if len(pairs) == 1:
+                value = values[pairs[0][0]]
+            else:
+                value = 0.0
+                for position, weight in pairs:
+                    if values[position] == missing_value:
+                        value = missing_value
+                        break
+                    value += values[position] * weight
+
+            lines.append(station_id + "," + date + "," + \
+                         "%4.2f" % value + "\n")
+
+        return "".join(lines)
+
+    def extract_file(self, filename, zipped, kind, first, last, out_file):
+        """ Writes the CSV text of every station for the time steps of a file
+        from first to last to out_file, reading only the values of their
+        cells.
+
+        Returns:
+            The number of time steps written.
+
+        """
+        if zipped:
+            handle = gzip.open(filename, 'rb')
+        else:
+            handle = open(filename, 'rb')
+
+        try:
+            header = gpcp_parsers.read_header(handle)
+            parser = gpcp_parsers.header_parser(header,
+                                                cube.KIND_PARSERS[kind])
+            grid_spec = parser.grid_spec()
+            ranges, weights = self.resolve(grid_spec)
+            missing_value = float(parser.variables["missing_value"])
+
+            step_size = grid_spec[2] * grid_spec[3] * 4
+            dates = cube.step_dates(parser.variables, kind,
+                                    parser.declared_steps())
+            written = 0
+            for step, the_date in enumerate(dates):
+                if not query.date_key(first) <= the_date <= \
+                       query.date_key(last):
+                    continue
+
+                try:
+                    values = gpcp_parsers.read_ranges(handle,
+                                                      len(header) +
+                                                      step * step_size,
+                                                      ranges)
+                except IOError:
+                    # A truncated file holds no more time steps.
+                    break
+
+                out_file.write(self.format_step(str(the_date), values,
+                                                weights, missing_value))
+                written += 1
+
+        finally:
+            handle.close()
+
+        return written
+
+#------------------------------------------------------------------------------
+#     Main
+#------------------------------------------------------------------------------
+
+
+def main():
+    """ The 'main' function used to run the file/modules as a stand alone
+    application.
+
+    """
+    parser = argparse.ArgumentParser(description="Writes the GPCP time " + \
+                                     "series of a list of stations to " + \
+                                     "CSV, reading only their values.")
+    parser.add_argument('-t',
+                        '--stations',
+                        required=True,
+                        help="A CSV file of station_id,latitude,longitude " + \
+                             "lines in signed decimal degrees.")
+    parser.add_argument('-m',
+                        '--method',
+                        default="nearest",
+                        help="nearest to take the value of the cell a " + \
+                             "station is in or bilinear to weight the " + \
+                             "cells around it, the default is nearest.")
+    parser.add_argument('-s',
+                        '--start',
+                        required=True,
+                        help="The first date, i.e. 19961001.")
+    parser.add_argument('-e',
+                        '--end',
+                        required=True,
+                        help="The last date, i.e. 20111231.")
+    parser.add_argument('-f',
+                        '--format',
+                        default='2',
+                        help="1 for the monthly files or 2 for the daily " + \
+                             "files, the default is 2.")
+    parser.add_argument('-p',
+                        '--input_prefix',
+                        default="./gpcp_1dd_v1.2_p1d.",
+                        help="The path and prefix of the input files as " + \
+                             "for gpcp_to_csv.")
+    parser.add_argument('-z',
+                        '--gzip',
+                        action='store_true',
+                        help="Set this flag if the input files are " + \
+                             "zipped using gzip and end with .gz.")
+    parser.add_argument('-c',
+                        '--catalog',
+                        default="",
+                        help="A catalog file written by catalog.py to " + \
+                             "take the files from instead of the prefix.")
+    parser.add_argument('-o',
+                        '--output_file',
+                        default="./gpcp_points.csv",
+                        help="The CSV file to write, the default is " + \
+                             "'./gpcp_points.csv'.")
+    args = parser.parse_args()
+
+    try:
+        first = query.parse_date(args.start)
+        last = query.parse_date(args.end)
+        stations = StationSet(load_stations(args.stations), args.method)
+    except (IOError, ValueError), error:
+        parser.error(str(error))
+
+    if int(args.format) not in query.FORMAT_KINDS:
+        parser.error("Please enter a format option of 1 or 2.")
+    kind = query.FORMAT_KINDS[int(args.format)]
+
+    the_catalog = None
+    if args.catalog != "":
+        the_catalog = catalog.load_catalog(args.catalog)
+
+    written = 0
+    with open(args.output_file, 'w') as out_file:
+        for filename, zipped in query.resolve_files(kind, first, last,
+                                                    args.input_prefix,
+                                                    args.gzip, the_catalog):
+            try:
+                written += stations.extract_file(filename, zipped, kind,
+                                                 first, last, out_file)
+            except (IOError, ValueError), error:
+                print("\n" + error.__class__.__name__ + ": ", error)
+                print("Skipping file: " + filename + "\n")
+
+    print("\nWrote " + str(written) + " time steps of " + \
+          str(len(stations.stations)) + " stations to " + \
+          args.output_file + "\n")
+
+#------------------------------------------------------------------------------
+#     Name
+#------------------------------------------------------------------------------
+
+
+if __name__ == '__main__':
+    main()
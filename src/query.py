@@ -0,0 +1,334 @@
+#!/usr/local/bin/python2.6
+"""
+Purpose
+-------
+    Answers "these days (or months) over this box" from a whole archive of
+    GPCP files without converting them.  Only the files in the time range
+    are opened and only the bytes of the time steps, rows and columns in
+    the box are read, so the cost is in proportion to the answer and not to
+    the archive.
+
+Program Flow
+------------
+    Input:
+        The first and last date, the box and where the files are, by the
+        input prefix naming scheme of gpcp_to_csv, a catalog from
+        catalog.py or a store from cube.py, i.e.
+        python query.py -s 19961001 -e 19961015 -b=-35,-20,38,52 -f 2 -z
+                        -p ./gpcp_1dd_v1.2_p1d. -o africa.csv
+
+    Output:
+        One CSV file in the one-line format of gpcp_to_csv:
+        YYYYMMDD,latitude,longitude,value
+        for the cells whose centers are in the box, in file order, for each
+        time step in the date range.
+
+
+Notes/Lessons Learned
+---------------------
+    The rows and columns of the box come from the grid of each file, see
+    mapping.box_slices, so a box given in 0 to 360 degree longitudes works
+    the same as in -180 to 180.  Byte ranges that touch are read together,
+    a box the full width of the grid is one read per time step.
+
+    A gzip file can not be read at an offset, it is decompressed up to the
+    last time step needed, but still only the box is decoded and formatted.
+
+--------
+
+"""
+#------------------------------------------------------------------------------
+#     Imports
+#------------------------------------------------------------------------------
+
+
+# The __future__ print function is used to ensure an easier path to
+# Python 3 if and when the upgrade is needed.
+from __future__ import print_function
+
+# built-ins
+import argparse
+import array
+import datetime
+import gzip
+import os
+
+# external
+import catalog
+import cube
+import gpcp_parsers
+import mapping
+
+# The kind of file for each format option.
+FORMAT_KINDS = {1: "monthly", 2: "daily"}
+
+#------------------------------------------------------------------------------
+#     Functions
+#------------------------------------------------------------------------------
+
+
+def parse_date(text):
+    """ Returns the datetime.date of a YYYYMMDD date. """
+    return datetime.datetime.strptime(text, "%Y%m%d").date()
+
+
+def date_key(a_date):
+    """ Returns a date as the YYYYMMDD number used by cube.step_dates. """
+    return int(a_date.strftime("%Y%m%d"))
+
+
+def resolve_files(kind, first, last, input_prefix="", zipped=False,
+                  the_catalog=None):
+    """ Returns the (file name, zipped) of each file of kind holding a date
+    from first to last, from the catalog if one is given or else named by
+    the input prefix as gpcp_to_csv names them.  Files that do not exist
+    are printed and left out.  Only the catalog entries that are zipped, or
+    not, as zipped is are taken, as for the -c option of gpcp_to_csv, so a
+    file cataloged both plain and zipped is only read once.
+
+    """
+    files = []
+    if the_catalog is not None:
+        for entry in catalog.find_files(the_catalog,
+                                        range(first.year, last.year + 1),
+                                        kinds=(kind,)):
+            if entry["zipped"] != zipped:
+                continue
+            if kind == "daily" and \
+               not (first.year, first.month) <= \
+                   (entry["year"], entry["month"]) <= \
+                   (last.year, last.month):
+                continue
+
+            files.append((entry["path"], entry["zipped"]))
+
+        return files
+
+    names = []
+    if kind == "monthly":
+        names = [str(year) for year in xrange(first.year, last.year + 1)]
+    else:
+        year, month = first.year, first.month
+        while (year, month) <= (last.year, last.month):
+            names.append(str(year) + str(month).zfill(2))
+            year, month = divmod(year * 12 + month, 12)
+            month += 1
+
+    for name in names:
+        filename = input_prefix + name + (".gz" if zipped else "")
+        if os.path.exists(filename):
+            files.append((filename, zipped))
+        else:
+            print("Skipping missing file: " + filename)
+
+    return files
+
+
+def query_file(filename, zipped, kind, first, last, box, out_file,
+               fixed_width=False):
+    """ Writes the CSV text of the cells in box for the time steps of a file
+    from first to last to out_file, reading only their bytes.
+
+    Returns:
+        The number of time steps written.
+
+    """
+    if zipped:
+        handle = gzip.open(filename, 'rb')
+    else:
+        handle = open(filename, 'rb')
+
+    try:
+        header = gpcp_parsers.read_header(handle)
+        parser = gpcp_parsers.header_parser(header,
+                                            cube.KIND_PARSERS[kind],
+                                            box)
+        parser.fixed_width = fixed_width
+        grid_spec = parser.grid_spec()
+        ranges = gpcp_parsers.box_ranges(parser.slices, grid_spec[2])
+        template = parser.generate_template()
+
+        step_size = grid_spec[2] * grid_spec[3] * 4
+        dates = cube.step_dates(parser.variables, kind,
+                                parser.declared_steps())
+        written = 0
+        for step, the_date in enumerate(dates):
+            if not date_key(first) <= the_date <= date_key(last):
+                continue
+
+            try:
+                values = gpcp_parsers.read_ranges(handle,
+                                                  len(header) +
+                                                  step * step_size,
+                                                  ranges)
+            except IOError:
+                # A truncated file holds no more time steps.
+                break
+
+            out_file.write(gpcp_parsers.format_step(template, str(the_date),
+                                                    values))
+            written += 1
+
+    finally:
+        handle.close()
+
+    return written
+
+
+def query_store(store, kind, first, last, box, out_file, fixed_width=False):
+    """ Writes the CSV text of the cells in box for the time steps from
+    first to last in the cubes of kind of a store written by cube.py.
+
+    Returns:
+        The number of time steps written.
+
+    """
+    written = 0
+    for the_cube in cube.open_store(store):
+        try:
+            index = the_cube.index
+            if index["kind"] != kind:
+                continue
+
+            # Every file of a cube is on its grid, the template is made
+            # from the header of the first.
+            parser = gpcp_parsers.header_parser(
+                str(index["sources"][0]["header"]),
+                cube.KIND_PARSERS[kind],
+                box)
+            parser.fixed_width = fixed_width
+            template = parser.generate_template()
+
+            first_row, last_row, runs = parser.slices
+            for step, the_date in enumerate(index["times"]):
+                if not date_key(first) <= the_date <= date_key(last):
+                    continue
+
+                values = array.array('f')
+                for row in xrange(first_row, last_row + 1):
+                    for first_col, last_col in runs:
+                        values.extend(the_cube.read_box(step, row, row,
+                                                        first_col, last_col))
+
+                out_file.write(gpcp_parsers.format_step(template,
+                                                        str(the_date),
+                                                        values))
+                written += 1
+
+        finally:
+            the_cube.close()
+
+    return written
+
+#------------------------------------------------------------------------------
+#     Main
+#------------------------------------------------------------------------------
+
+
+def main():
+    """ The 'main' function used to run the file/modules as a stand alone
+    application.
+
+    """
+    parser = argparse.ArgumentParser(description="Writes the GPCP data " + \
+                                     "of a date range over a box to CSV, " + \
+                                     "reading only that data.")
+    parser.add_argument('-s',
+                        '--start',
+                        required=True,
+                        help="The first date, i.e. 19961001.")
+    parser.add_argument('-e',
+                        '--end',
+                        required=True,
+                        help="The last date, i.e. 19961015.")
+    parser.add_argument('-b',
+                        '--bbox',
+                        required=True,
+                        help="The box as S,W,N,E in signed decimal " + \
+                             "degrees, i.e. -b=-35,-20,38,52 (with the = " + \
+                             "if it starts with a minus).  A box with W " + \
+                             "greater than E crosses the 180 degree " + \
+                             "meridian.")
+    parser.add_argument('-f',
+                        '--format',
+                        default='2',
+                        help="1 for the monthly files or 2 for the daily " + \
+                             "files, the default is 2.")
+    parser.add_argument('-p',
+                        '--input_prefix',
+                        default="./gpcp_1dd_v1.2_p1d.",
+                        help="The path and prefix of the input files as " + \
+                             "for gpcp_to_csv.")
+    parser.add_argument('-z',
+                        '--gzip',
+                        action='store_true',
+                        help="Set this flag if the input files are " + \
+                             "zipped using gzip and end with .gz.")
+    parser.add_argument('-c',
+                        '--catalog',
+                        default="",
+                        help="A catalog file written by catalog.py to " + \
+                             "take the files from instead of the prefix.")
+    parser.add_argument('-S',
+                        '--store',
+                        default="",
+                        help="A store written by cube.py to read instead " + \
+                             "of the files.")
+    parser.add_argument('-o',
+                        '--output_file',
+                        default="./gpcp_query.csv",
+                        help="The CSV file to write, the default is " + \
+                             "'./gpcp_query.csv'.")
+    parser.add_argument('-F',
+                        '--fixed_width',
+                        action='store_true',
+                        help="Write fixed-width lines as with the -F " + \
+                             "option of gpcp_to_csv.")
+    args = parser.parse_args()
+
+    try:
+        first = parse_date(args.start)
+        last = parse_date(args.end)
+        box = mapping.parse_bbox(args.bbox)
+    except ValueError, error:
+        parser.error(str(error))
+
+    if int(args.format) not in FORMAT_KINDS:
+        parser.error("Please enter a format option of 1 or 2.")
+    kind = FORMAT_KINDS[int(args.format)]
+
+    with open(args.output_file, 'wb' if args.fixed_width else 'w') \
+         as out_file:
+        if args.store != "":
+            try:
+                written = query_store(args.store, kind, first, last, box,
+                                      out_file, args.fixed_width)
+            except (IOError, ValueError), error:
+                parser.error(str(error))
+        else:
+            the_catalog = None
+            if args.catalog != "":
+                the_catalog = catalog.load_catalog(args.catalog)
+
+            written = 0
+            for filename, zipped in resolve_files(kind, first, last,
+                                                  args.input_prefix,
+                                                  args.gzip, the_catalog):
+                try:
+                    written += query_file(filename, zipped, kind, first,
+                                          last, box, out_file,
+                                          args.fixed_width)
+                except (IOError, ValueError), error:
+                    print("\n" + error.__class__.__name__ + ": ", error)
+                    print("Skipping file: " + filename + "\n")
+
+    print("\nWrote " + str(written) + " time steps to " + \
+          args.output_file + "\n")
+
+#------------------------------------------------------------------------------
+#     Name
+#------------------------------------------------------------------------------
+
+
+if __name__ == '__main__':
+    main()
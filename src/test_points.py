@@ -0,0 +1,141 @@
+#!/usr/local/bin/python2.6
+"""
+Purpose
+-------
+    Tests the station extraction of points.py against a small GPCP file
+    written by the test itself.
+
+Program Flow
+------------
+    Input:
+        None, run from the src directory, i.e.
+        python test_points.py
+
+    Output:
+        The unittest report.
+
+
+Notes/Lessons Learned
+---------------------
+    The test file is a 4 x 2 grid of 90 degree cells with two monthly time
+    steps, the value of each cell being 10 times the time step plus its
+    index in file order, so every value written says where it came from.
+
+--------
+
+"""
+#------------------------------------------------------------------------------
+#     Imports
+#------------------------------------------------------------------------------
+
+
+# built-ins
+import array
+import datetime
+import gzip
+import os
+import shutil
+import StringIO
+import sys
+import tempfile
+import unittest
+
+# external
+import catalog
+import points
+import query
+
+# The header of the test file, padded to HEADER_SIZE bytes.
+HEADER_SIZE = 256
+HEADER = "size=(char*256) header + (real*4)x4x2x2) data " + \
+         "year=1987 months=1-2 grid=90x90 " + \
+         "1st_box_center=(45.0N,45.0E) 2nd_box_center=(45.0N,135.0E) " + \
+         "last_box_center=(45.0S,315.0E) missing_value=-99999."
+
+#------------------------------------------------------------------------------
+#     Functions
+#------------------------------------------------------------------------------
+
+
+def write_test_file(filename):
+    """ Writes the test file to filename. """
+    values = array.array('f', [step * 10 + cell
+                               for step in xrange(2)
+                               for cell in xrange(8)])
+    if sys.byteorder == "little":
+        values.byteswap()
+
+    with open(filename, 'wb') as handle:
+        handle.write(HEADER.ljust(HEADER_SIZE))
+        values.tofile(handle)
+
+#------------------------------------------------------------------------------
+#     Class:  TestPoints
+#------------------------------------------------------------------------------
+
+
+class TestPoints(unittest.TestCase):
+    """ Tests StationSet with the files from query.resolve_files. """
+    def setUp(self):
+        """ Writes the test file, a gzip copy of it and a catalog of both. """
+        self.directory = tempfile.mkdtemp()
+        self.plain = os.path.join(self.directory, "gpcp_v2.2_psg.1987")
+        write_test_file(self.plain)
+
+        zipped = gzip.open(self.plain + ".gz", 'wb')
+        try:
+            with open(self.plain, 'rb') as handle:
+                zipped.write(handle.read())
+        finally:
+            zipped.close()
+
+        self.catalog = catalog.build_catalog(self.directory)
+        self.stations = points.StationSet([("north", 40.0, 50.0),
+                                           ("south", -44.0, -40.0)])
+
+    def tearDown(self):
+        """ Removes the test files. """
+        shutil.rmtree(self.directory)
+
+    def extract(self, zipped):
+        """ Returns the lines written for the stations from the files the
+        catalog gives for zipped.
+
+        """
+        first = datetime.date(1987, 1, 1)
+        last = datetime.date(1987, 12, 31)
+        out_file = StringIO.StringIO()
+        for filename, is_zipped in query.resolve_files("monthly", first,
+                                                       last, zipped=zipped,
+                                                       the_catalog=
+                                                       self.catalog):
+            self.stations.extract_file(filename, is_zipped, "monthly",
+                                       first, last, out_file)
+
+        return out_file.getvalue().splitlines()
+
+    def test_catalog_with_both_copies(self):
+        """ A file cataloged plain and zipped is only read once. """
+        self.assertEqual(len(self.catalog["files"]), 2)
+
+        expected = ["north,19870101,0.00",
+                    "south,19870101,7.00",
+                    "north,19870201,10.00",
+                    "south,19870201,17.00"]
+        self.assertEqual(self.extract(False), expected)
+        self.assertEqual(self.extract(True), expected)
+
+    def test_bilinear(self):
+        """ A station between four cell centers is weighted from them. """
+        self.stations = points.StationSet([("middle", 0.0, 90.0)],
+                                          "bilinear")
+        # Halfway between cells 0, 1, 4 and 5.
+        self.assertEqual(self.extract(False)[0], "middle,19870101,2.50")
+
+#------------------------------------------------------------------------------
+#     Name
+#------------------------------------------------------------------------------
+
+
+if __name__ == '__main__':
+    unittest.main()
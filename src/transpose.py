@@ -0,0 +1,266 @@
+#!/usr/local/bin/python2.6
+"""
+Purpose
+-------
+    Writes a batch of GPCP files as one CSV file grouped by cell instead of
+    by time step, every date of the first cell then every date of the next
+    and so on, for databases that keep the data of each location together.
+    The batch can be far bigger than memory.
+
+Program Flow
+------------
+    Input:
+        The GPCP files of a batch in date order, all on the same grid, i.e.
+        from gpcp_to_csv with -T,
+        python gpcp_to_csv.py -y 1996,2011 -m 1,2,3,4,5,6,7,8,9,10,11,12 -z
+                              -f 2 -p ./gpcp_1dd_v1.2_p1d. -T daily_cells.csv
+
+    Output:
+        One CSV file in the one-line format of gpcp_to_csv:
+        YYYYMMDD,latitude,longitude,value
+        with the cells in file order and the dates of each cell in the
+        order of the batch.
+
+
+Notes/Lessons Learned
+---------------------
+    The transpose is done out of core in two passes, each held to the memory
+    limit.  The first fills a block of time steps in memory and spills it
+    to a temporary file in cell order, the time steps of the first cell then
+    the second and so on.  The second reads the same run of cells from every
+    spill file, joins the time series of each cell from the blocks in order
+    and writes them out.  The blocks are in date order so no sorting is
+    needed, the merge is a read of each block in turn.
+
+    Each input file is decoded whole before its time steps are added, so a
+    file that can not be read never leaves half its time steps behind.
+
+--------
+
+"""
+#------------------------------------------------------------------------------
+#     Imports
+#------------------------------------------------------------------------------
+
+
+# The __future__ print function is used to ensure an easier path to
+# Python 3 if and when the upgrade is needed.
+from __future__ import print_function
+
+# built-ins
+import array
+import gzip
+import os
+import shutil
+import tempfile
+
+# external
+import gpcp_parsers
+import manifest
+
+# The default memory limit of each pass of the transpose, in megabytes.
+DEFAULT_MEMORY = 256
+
+#------------------------------------------------------------------------------
+#     Functions
+#------------------------------------------------------------------------------
+
+
+def open_input(input_filename, zipped, parser_class=None, box=None):
+    """ Returns the parser of a GPCP file with all its data decoded.
+
+    Raises:
+        IOError if the file can not be read or is not a GPCP file.
+        ValueError if no cell of the grid is in box.
+
+    """
+    if not zipped:
+        return gpcp_parsers.open_parser(input_filename,
+                                        parser_class=parser_class,
+                                        box=box)
+
+    handle = gzip.open(input_filename, 'rb')
+    try:
+        return gpcp_parsers.open_parser(handle,
+                                        parser_class=parser_class,
+                                        box=box)
+    finally:
+        handle.close()
+
+
+def write_cell_major(input_files, parser_class, zipped, output_filename,
+                     memory=DEFAULT_MEMORY, prefix_cache="", fixed_width=False,
+                     box=None):
+    """ Writes the time steps of every file of input_files to one CSV file
+    grouped by cell, see Transposer.  Files on a different grid to the
+    first one read are skipped.  memory is the limit of each pass in
+    megabytes, the spill files are kept next to the output.
+
+    Returns:
+        A tuple of (successes, failures).
+
+    """
+    successes = 0
+    failures = 0
+    transposer = None
+    grid = None
+    try:
+        for input_filename in input_files:
+            print("\nExtracting data from: ", input_filename)
+            try:
+                parser = open_input(input_filename, zipped, parser_class, box)
+            except (IOError, ValueError), error:
+                print("\n" + error.__class__.__name__ + ": ", error)
+                print("Skipping file: " + input_filename + "\n")
+                failures += 1
+                continue
+
+            if prefix_cache != "":
+                parser.prefix_cache_dir = prefix_cache
+            parser.fixed_width = fixed_width
+
+            if transposer is None:
+                grid = (parser.grid_spec(), parser.slices)
+                transposer = Transposer(parser.cells_per_step(),
+                                        memory,
+                                        os.path.dirname(
+                                            os.path.abspath(output_filename)))
+                prefixes = parser.cell_prefixes()
+                value_format = parser.value_format()
+
+            elif (parser.grid_spec(), parser.slices) != grid:
+                print("Skipping file on a different grid: " + input_filename)
+                parser.close()
+                failures += 1
+                continue
+
+            for step, values in parser.iter_steps():
+                transposer.add_step(parser.step_date(step), values)
+            parser.close()
+            successes += 1
+
+        if transposer is None:
+            return successes, failures
+
+        pieces = "".join([the_date + "," + gpcp_parsers.DATE_MARK +
+                          value_format + "\n"
+                          for the_date in transposer.dates]) \
+                 .split(gpcp_parsers.DATE_MARK)
+        record_size = gpcp_parsers.FIXED_RECORD_SIZE * len(transposer.dates)
+
+        try:
+            with open(manifest.part_name(output_filename),
+                      'wb' if fixed_width else 'w') as out_file:
+                for cell, values in transposer.iter_cells():
+                    text = prefixes[cell].join(pieces) % tuple(values)
+                    if fixed_width and len(text) != record_size:
+                        raise ValueError("A value is too wide for the " + \
+                                         "fixed-width records.")
+                    out_file.write(text)
+
+        except (IOError, ValueError), error:
+            print("\n" + error.__class__.__name__ + ": ", error)
+            print("Skipping output: " + output_filename + "\n")
+            if os.path.exists(manifest.part_name(output_filename)):
+                os.remove(manifest.part_name(output_filename))
+            return 0, successes + failures
+
+        manifest.commit_output(output_filename)
+
+    finally:
+        if transposer is not None:
+            transposer.close()
+
+    return successes, failures
+
+#------------------------------------------------------------------------------
+#     Class:  Transposer
+#------------------------------------------------------------------------------
+
+
+class Transposer(object):
+    """ Turns time steps of the same cells, added in date order, into the
+    time series of each cell with bounded memory.
+
+    """
+    def __init__(self, cells, memory=DEFAULT_MEMORY, spill_dir=None):
+        """ The initialization function for an object.  cells is the number
+        of values in each time step and memory the limit of each pass in
+        megabytes.  The spill files are kept in a temporary directory made
+        in spill_dir, removed by close().
+
+        """
+        self.cells = cells
+        self.max_bytes = memory * 1024 * 1024
+        self.block_steps = max(1, self.max_bytes // (cells * 4))
+        self.dates = []
+
+        # The (file name, number of time steps) of each block spilled.
+        self.spills = []
+        self._block = array.array('f')
+
+        self.directory = tempfile.mkdtemp(prefix="gpcp_transpose_",
+                                          dir=spill_dir)
+
+    def add_step(self, the_date, values):
+        """ Adds the values of the next time step, spilling the block to
+        disk once it holds block_steps time steps.
+
+        Raises:
+            ValueError if values is not one value for each cell.
+
+        """
+        if len(values) != self.cells:
+            raise ValueError("A time step does not have the cells of the " + \
+                             "first one.")
+
+        self._block.extend(values)
+        self.dates.append(the_date)
+        if len(self._block) >= self.block_steps * self.cells:
+            self.spill()
+
+    def spill(self):
+        """ Writes the block in memory to a spill file in cell order. """
+        steps = len(self._block) // self.cells
+        if steps == 0:
+            return
+
+        name = os.path.join(self.directory,
+                            "block_" + str(len(self.spills)).zfill(6) + ".f32")
+        with open(name, 'wb') as handle:
+            for cell in xrange(self.cells):
+                self._block[cell::self.cells].tofile(handle)
+
+        self.spills.append((name, steps))
+        self._block = array.array('f')
+
+    def iter_cells(self):
+        """ Yields (cell, values) for every cell in order with its values
+        for every time step added, in the order they were added.  The cells
+        are read from the spill files a run at a time, as many as fit in the
+        memory limit.
+
+        """
+        self.spill()
+        batch = max(1, self.max_bytes // (max(len(self.dates), 1) * 4))
+        for first in xrange(0, self.cells, batch):
+            count = min(batch, self.cells - first)
+
+            chunks = []
+            for name, steps in self.spills:
+                chunk = array.array('f')
+                with open(name, 'rb') as handle:
+                    handle.seek(first * steps * 4)
+                    chunk.fromfile(handle, count * steps)
+                chunks.append((chunk, steps))
+
+            for index in xrange(count):
+                values = array.array('f')
+                for chunk, steps in chunks:
+                    values.extend(chunk[index * steps:(index + 1) * steps])
+
+                yield first + index, values
+
+    def close(self):
+        """ Removes the spill files. """
+        shutil.rmtree(self.directory, ignore_errors=True)
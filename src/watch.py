@@ -0,0 +1,337 @@
+#!/usr/local/bin/python2.6
+"""
+Purpose
+-------
+    Watches a landing directory and converts each GPCP file to CSV as soon
+    as it has finished arriving, or has been updated, instead of running
+    gpcp_to_csv over guessed file names from cron.  It runs until stopped
+    with Ctrl+C.
+
+Program Flow
+------------
+    Input:
+        The directory to watch and the directory to write the CSV files to,
+        i.e. python watch.py /data/landing -o /data/csv
+
+    Output:
+        One CSV file per GPCP file, named after it as for the -d option of
+        gpcp_to_csv, and the manifest of the output directory, see manifest.
+
+    The directory is polled every interval seconds.  A file is converted
+    once its size and modification time are the same in two polls in a row,
+    or at once if inotify reports it was closed after writing.  The manifest
+    is always kept, so a restarted watcher skips the files it already
+    converted.
+
+
+Notes/Lessons Learned
+---------------------
+    The converting is done by one pool of processes, or by this process
+    with -j 1, that lives as long as the watcher.  The coordinate tables and
+    templates each process builds are kept between files, so only the first
+    file of each grid pays for them and no file pays for starting Python.
+
+    inotify is only used when the pyinotify package is installed, it only
+    saves waiting for the next poll to see a file has stopped changing.
+
+--------
+
+"""
+#------------------------------------------------------------------------------
+#     Imports
+#------------------------------------------------------------------------------
+
+
+# The __future__ print function is used to ensure an easier path to
+# Python 3 if and when the upgrade is needed.
+from __future__ import print_function
+
+# built-ins
+import argparse
+import multiprocessing
+import os
+import stat
+import time
+
+# external
+import gpcp_to_csv
+import manifest
+
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
+# Files in the watched directory that are never converted, the watched and
+# output directories may be the same.
+IGNORED_SUFFIXES = (".csv", ".json", manifest.PART_SUFFIX)
+
+#------------------------------------------------------------------------------
+#     Functions
+#------------------------------------------------------------------------------
+
+
+def output_name(input_filename, output_dir):
+    """ Returns the CSV file name for input_filename in output_dir. """
+    name = os.path.basename(input_filename)
+    if name.endswith(".gz"):
+        name = name[:-3]
+
+    return os.path.join(output_dir, name + ".csv")
+
+
+def convert_ready(paths, output_dir, format_opt, jobs, options, pool=None):
+    """ Converts the GPCP files in paths with gpcp_to_csv.process_files,
+    the zipped and plain files as separate batches.
+
+    Returns:
+        A tuple of (successes, failures).
+
+    """
+    successes = 0
+    failures = 0
+    for zipped in (False, True):
+        files = [(path, output_name(path, output_dir))
+                 for path in paths if path.endswith(".gz") == zipped]
+        if files:
+            converted, failed = gpcp_to_csv.process_files(files,
+                                                          format_opt,
+                                                          zipped,
+                                                          jobs,
+                                                          options,
+                                                          pool)
+            successes += converted
+            failures += failed
+
+    return successes, failures
+
+#------------------------------------------------------------------------------
+#     Class:  ClosedFiles
+#------------------------------------------------------------------------------
+
+
+class ClosedFiles(object):
+    """ Collects the files inotify reports as closed after writing or moved
+    into the watched directory.  Used as the default function of a
+    pyinotify.Notifier.
+
+    """
+    def __init__(self):
+        """ The initialization function for an object. """
+        self.paths = set()
+
+    def __call__(self, event):
+        """ Adds the file of event. """
+        self.paths.add(os.path.abspath(event.pathname))
+
+#------------------------------------------------------------------------------
+#     Class:  DirectoryWatcher
+#------------------------------------------------------------------------------
+
+
+class DirectoryWatcher(object):
+    """ Finds the files of a directory that have finished arriving. """
+    def __init__(self, directory, interval):
+        """ The initialization function for an object.  interval is the
+        number of seconds between polls.
+
+        """
+        self.directory = os.path.abspath(directory)
+        self.interval = interval
+
+        # The (size, modification time) of each file at the last poll and
+        # when it was last handed out by ready_files.
+        self._seen = {}
+        self._handed_out = {}
+
+        self._closed = ClosedFiles()
+        self._notifier = None
+        if pyinotify is not None:
+            watch_manager = pyinotify.WatchManager()
+            watch_manager.add_watch(self.directory,
+                                    pyinotify.IN_CLOSE_WRITE | \
+                                    pyinotify.IN_MOVED_TO)
+            self._notifier = pyinotify.Notifier(watch_manager, self._closed)
+
+    def ready_files(self):
+        """ Returns the files that are new or changed since they were last
+        returned and have stopped changing, sorted by name.
+
+        """
+        ready = []
+        seen = {}
+        for name in sorted(os.listdir(self.directory)):
+            if name.startswith(".") or name.endswith(IGNORED_SUFFIXES):
+                continue
+
+            path = os.path.join(self.directory, name)
+            try:
+                file_stat = os.stat(path)
+            except OSError:
+                # Removed since it was listed.
+                continue
+
+            if not stat.S_ISREG(file_stat.st_mode):
+                continue
+
+            signature = (file_stat.st_size, file_stat.st_mtime)
+            seen[path] = signature
+            if self._seen.get(path) != signature and \
+               path not in self._closed.paths:
+                # Still arriving, or just arrived, check it next poll.
+                continue
+
+            if self._handed_out.get(path) != signature:
+                self._handed_out[path] = signature
+                ready.append(path)
+
+        # Only the files still there are remembered.
+        self._seen = seen
+        for path in self._handed_out.keys():
+            if path not in seen:
+                del self._handed_out[path]
+        self._closed.paths.clear()
+
+        return ready
+
+    def wait(self):
+        """ Waits for the next poll, cut short when inotify reports a file
+        has been written.
+
+        """
+        if self._notifier is None:
+            time.sleep(self.interval)
+        elif self._notifier.check_events(int(self.interval * 1000)):
+            self._notifier.read_events()
+            self._notifier.process_events()
+
+    def close(self):
+        """ Stops the inotify watch if there is one. """
+        if self._notifier is not None:
+            self._notifier.stop()
+
+#------------------------------------------------------------------------------
+#     Main
+#------------------------------------------------------------------------------
+
+
+def main():
+    """ The 'main' function used to run the file/modules as a stand alone
+    application.
+
+    """
+    parser = argparse.ArgumentParser(description="Watches a directory " + \
+                                     "and converts each GPCP file to CSV " + \
+                                     "as soon as it has arrived.")
+    parser.add_argument('directory',
+                        help="The directory to watch, files ending in " + \
+                             ".gz are read as gzip files.")
+    parser.add_argument('-o',
+                        '--output_dir',
+                        default="./",
+                        help="The directory to write the CSV files to, " + \
+                             "the default is './'.")
+    parser.add_argument('-f',
+                        '--format',
+                        default='3',
+                        help="The format option as for gpcp_to_csv, the " + \
+                             "default is 3, detected from each file.")
+    parser.add_argument('-i',
+                        '--interval',
+                        default='5',
+                        help="The number of seconds between polls of the " + \
+                             "directory, the default is 5.")
+    parser.add_argument('-j',
+                        '--jobs',
+                        default='1',
+                        help="The number of processes to convert files " + \
+                             "with, the default is 1, this process.")
+    parser.add_argument('-F',
+                        '--fixed_width',
+                        action='store_true',
+                        help="Write fixed-width lines as with the -F " + \
+                             "option of gpcp_to_csv.")
+    parser.add_argument('-I',
+                        '--incremental',
+                        action='store_true',
+                        help="Only add the months or days published " + \
+                             "since a file was last converted as with " + \
+                             "the -I option of gpcp_to_csv.")
+    parser.add_argument('-P',
+                        '--prefix_cache',
+                        default="",
+                        help="A directory to keep the rendered latitude " + \
+                             "and longitude text of each grid in, as " + \
+                             "with the -P option of gpcp_to_csv.")
+    parser.add_argument('--once',
+                        action='store_true',
+                        help="Convert what is in the directory once and " + \
+                             "stop instead of watching it.")
+    args = parser.parse_args()
+
+    format_opt = int(args.format)
+    if format_opt not in gpcp_to_csv.PARSERS:
+        parser.error("Please enter a format option of 0, 1, 2 or 3.")
+    if (args.fixed_width or args.incremental) and format_opt == 0:
+        parser.error("Please use -F and -I with format 1, 2 or 3.")
+    if not os.path.isdir(args.output_dir):
+        parser.error("The output directory " + args.output_dir + \
+                     " does not exist.")
+
+    jobs = int(args.jobs)
+    options = {"prefix_cache": args.prefix_cache,
+               "fixed_width": args.fixed_width,
+               "incremental": args.incremental,
+               "manifest": True}
+
+    watcher = DirectoryWatcher(args.directory, float(args.interval))
+    pool = None
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs)
+
+    if args.once:
+        # Everything there is taken as arrived, the first poll only takes
+        # note of the files and the second hands them all out.
+        watcher.ready_files()
+    else:
+        print("\nWatching " + args.directory + " for GPCP files, " + \
+              "press Ctrl+C to stop.")
+
+    try:
+        while True:
+            # Files are converted once they are seen not to change.
+            ready = watcher.ready_files()
+            if ready:
+                successes, failures = convert_ready(ready,
+                                                    args.output_dir,
+                                                    format_opt,
+                                                    jobs,
+                                                    options,
+                                                    pool)
+                print("\nConverted " + str(successes) + " files, " + \
+                      str(failures) + " failed.")
+
+            if args.once:
+                break
+
+            watcher.wait()
+
+    except KeyboardInterrupt:
+        print("\nStopped watching " + args.directory + "\n")
+        if pool is not None:
+            pool.terminate()
+            pool = None
+
+    finally:
+        watcher.close()
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+#------------------------------------------------------------------------------
+#     Name
+#------------------------------------------------------------------------------
+
+
+if __name__ == '__main__':
+    main()